@@ -1,5 +1,6 @@
 from PyRT_Core import *
 from PyRT_Integrators import *
+from GaussianProcess import *
 import time
 
 def sphere_scene(envMap=None):
@@ -153,6 +154,11 @@ env_map_path = 'env_maps/arch_nozero.hdr'
 # -------------------------------------------------Main
 # Create Integrator
 integrator = CMCIntegrator(10, DIRECTORY + FILENAME)
+# integrator = BayesianMonteCarloIntegrator(40, GP(SECov(0.5), CosineLobe(1)), DIRECTORY + FILENAME)
+# integrator = MISIntegrator(16, DIRECTORY + FILENAME)  # for cornell_box_scene(..., areaLS=True)
+# integrator = PathTracingIntegrator(64, DIRECTORY + FILENAME)  # render with packet=True
+# integrator = IrradianceMapIntegrator(DIRECTORY + FILENAME)  # sphere_scene with an environment map
+# integrator = SHIrradianceIntegrator(DIRECTORY + FILENAME, order=2)  # sphere_scene with an environment map
 
 # Create the scene
 scene = sphere_scene(envMap=env_map_path)
@@ -165,6 +171,7 @@ if __name__ == "__main__":
     # Render!
     start_time = time.time()
     integrator.render()
+    # integrator.render_incremental()  # after a change of the scene: re-renders only the affected pixels
     end_time = time.time() - start_time
     print("--- Rendering time: %s seconds ---" % end_time)
 
@@ -30,6 +30,93 @@ def compute_estimate_cmc(sample_prob_, sample_values_):
     return estimate / len(sample_values_)
 
 
+# ############################################################################################# #
+# Vectorized version of collect_samples: sample_pos_ is an (..., 3) array of directions. Returns #
+# the (...) array with the product of all the functions in function_list for each direction.     #
+# ############################################################################################# #
+def collect_samples_batch(function_list, sample_pos_):
+    dirs = sample_pos_.reshape(-1, 3)
+    sample_values = np.ones(len(dirs))
+    for function in function_list:
+        sample_values *= function.eval_batch(dirs)
+    return sample_values.reshape(sample_pos_.shape[:-1])
+
+
+# ############################################################################################ #
+# Vectorized version of compute_estimate_cmc: sample_prob_ and sample_values_ are              #
+# (n_estimates, ns) arrays, returns the (n_estimates,) array of classic Monte Carlo estimates. #
+# ############################################################################################ #
+def compute_estimates_cmc(sample_prob_, sample_values_):
+    return np.mean(sample_values_ / sample_prob_, axis=-1)
+
+
+# ############################################################################################# #
+# Control variate estimates: given the (n_estimates,) means of f(x_i) / p(x_i) and of the        #
+# samples g(x_i) / p(x_i) of a control variate g whose integral (control_integral) is known,     #
+# returns mean(f / p) - beta * (mean(g / p) - control_integral).                                #
+# ############################################################################################# #
+def compute_estimates_cv(f_means, g_means, control_integral, beta):
+    return f_means - beta * (g_means - control_integral)
+
+
+# ############################################################################################# #
+# Optimal control variate coefficient beta = Cov(f / p, g / p) / Var(g / p), from the sums of    #
+# g / p, f / p, (g / p)^2 and (f / p) * (g / p) over n samples (0 if the control is constant).  #
+# ############################################################################################# #
+def compute_cv_beta(sums, n):
+    sum_g, sum_f, sum_gg, sum_fg = sums
+    variance = sum_gg - sum_g * sum_g / n
+    covariance = sum_fg - sum_f * sum_g / n
+    return covariance / variance if variance > 0.0 else 0.0
+
+
+# ############################################################################################### #
+# Experiment engine: for each sample count ns in ns_vector, computes n_estimates CMC estimates of  #
+# the integral of the product of the functions in function_list, using samples drawn from pdf.    #
+# The samples of a batch of estimates are drawn and evaluated as a single array (a batch holds at #
+# most max_batch_samples samples). Returns the mean absolute error, the variance of the estimates #
+# and the RMSE with respect to ground_truth, as three (len(ns_vector),) arrays.                   #
+# The (u1, u2) pairs come from sampler, one point set per estimate and sample count (by default   #
+# independent random numbers with the given seed), so the results do not depend on               #
+# max_batch_samples.                                                                              #
+# control: optional (control_function_list, control_integral) control variate. The estimates are  #
+# then compute_estimates_cv, with one optimal beta per experiment (sample count) estimated from   #
+# all the samples of its estimates.                                                               #
+# ############################################################################################### #
+def run_experiment(function_list, pdf, ns_vector, n_estimates, ground_truth, max_batch_samples=2 ** 20, seed=0,
+                   sampler=None, control=None):
+    if sampler is None:
+        sampler = IndependentSampler(seed)
+    mean_abs_error = np.zeros(len(ns_vector))
+    variance = np.zeros(len(ns_vector))
+    rmse = np.zeros(len(ns_vector))
+    for k, ns in enumerate(ns_vector):
+        estimates = np.zeros(n_estimates)
+        g_means = np.zeros(n_estimates)  # means of the control variate samples
+        cv_sums = np.zeros(4)  # sums of g / p, f / p, (g / p)^2 and (f / p) * (g / p)
+        batch_size = max(1, max_batch_samples // ns)  # number of estimates per batch
+        for start in range(0, n_estimates, batch_size):
+            n_batch = min(batch_size, n_estimates - start)
+            stream_ids = k * n_estimates + np.arange(start, start + n_batch)
+            samples_pos = pdf.generate_dirs(sampler.generate(stream_ids, ns, 2).reshape((-1, 2)))
+            samples_prob = pdf.get_vals(samples_pos).reshape(n_batch, ns)
+            samples_values = collect_samples_batch(function_list, samples_pos).reshape(n_batch, ns)
+            estimates[start:start + n_batch] = compute_estimates_cmc(samples_prob, samples_values)
+            if control is not None:
+                f = samples_values / samples_prob
+                g = collect_samples_batch(control[0], samples_pos).reshape(n_batch, ns) / samples_prob
+                g_means[start:start + n_batch] = np.mean(g, axis=-1)
+                cv_sums += (np.sum(g), np.sum(f), np.sum(g * g), np.sum(f * g))
+        if control is not None:
+            beta = compute_cv_beta(cv_sums, n_estimates * ns)
+            estimates = compute_estimates_cv(estimates, g_means, control[1], beta)
+        errors = estimates - ground_truth
+        mean_abs_error[k] = np.mean(np.abs(errors))
+        variance[k] = np.var(estimates)
+        rmse[k] = np.sqrt(np.mean(errors ** 2))
+    return mean_abs_error, variance, rmse
+
+
 # ----------------------------- #
 # ---- Main Script Section ---- #
 # ----------------------------- #
@@ -39,7 +126,8 @@ def compute_estimate_cmc(sample_prob_, sample_values_):
 # STEP 0                                                               #
 # Set-up the name of the used methods, and their marker (for plotting) #
 # #################################################################### #
-methods_label = [('MC', 'o')]
+methods_label = [('MC', 'o'), ('MC IS', 'v'), ('MC IS Stratified', 's'), ('MC IS Halton', '^'), ('MC IS Sobol', 'D'),
+                 ('MC CV Constant', 'P'), ('MC IS CV SH', '*')]
 # methods_label = [('MC', 'o'), ('MC IS', 'v'), ('BMC', 'x'), ('BMC IS', '1')] # for later practices
 n_methods = len(methods_label) # number of tested monte carlo methods
 
@@ -60,8 +148,28 @@ integrand = [l_i, brdf, cosine_term]  # l_i * brdf * cos
 # Set-up the pdf used to sample the hemisphere #
 # ############################################ #
 uniform_pdf = UniformPDF()
-#exponent = 1
-#cosine_pdf = CosinePDF(exponent)
+exponent = 1
+cosine_pdf = CosinePDF(exponent)
+methods_pdf = [uniform_pdf, cosine_pdf, cosine_pdf, cosine_pdf, cosine_pdf,  # pdf used by each method in methods_label
+               uniform_pdf, cosine_pdf]
+
+# ######################################################################## #
+# Set-up the sampler that generates the (u1, u2) pairs used by each method #
+# ######################################################################## #
+methods_sampler = [IndependentSampler(), IndependentSampler(), StratifiedSampler(),
+                   CranleyPattersonSampler(HaltonSampler()), SobolSampler(scramble='owen'),
+                   IndependentSampler(), IndependentSampler()]
+
+# ######################################################################################### #
+# Set-up the control variate of each method (None: plain estimator): a function list g with #
+# a known integral, here an approximation of l_i times the brdf and the cosine term:         #
+# - a constant (with cosine sampling g / p would be constant, hence uniform sampling)      #
+# - the order 2 spherical harmonics projection of the environment map (needs l_i.env_map)  #
+# ######################################################################################### #
+constant_control = ([Constant(1), brdf, cosine_term], kd * cosine_term.get_integral())
+sh_l_i = SHEnvMap(l_i.env_map, 2)
+sh_control = ([sh_l_i, brdf, cosine_term], kd * sh_l_i.get_integral())
+methods_control = [None, None, None, None, None, constant_control, sh_control]
 
 
 # ###################################################################### #
@@ -84,39 +192,27 @@ ns_vector = np.arange(start=ns_min, stop=ns_max, step=ns_step)  # the number of
 n_estimates = 1000  # the number of estimates to perform for each value in ns_vector
 n_samples_count = len(ns_vector)
 
-# Initialize a matrix of estimate error at zero
+# Initialize the matrices of average error, variance and RMSE at zero
 results = np.zeros((n_samples_count, n_methods))  # Matrix of average error
+results_variance = np.zeros((n_samples_count, n_methods))  # Matrix of estimate variance
+results_rmse = np.zeros((n_samples_count, n_methods))  # Matrix of RMSE
 
 
 # ################################# #
 #          MAIN LOOP                #
 # ################################# #
 
-# for each sample count considered
-for k, ns in enumerate(ns_vector):
+# for each method, compute the estimates for all the sample counts
+for m, method in enumerate(methods_label):
+    print(f'Computing estimates for {method[0]}')
+    results[:, m], results_variance[:, m], results_rmse[:, m] = run_experiment(
+        integrand, methods_pdf[m], ns_vector, n_estimates, ground_truth, sampler=methods_sampler[m],
+        control=methods_control[m])
 
-    print(f'Computing estimates using {ns} samples')
-
-    # Stores the absolute errors for each estimate
-    errors = []
-    for _ in range(n_estimates):
-        samples_pos = []
-        samples_prob = []
-
-        for i in range(ns):
-            # Obtain random numbers to generate a sample direction
-            u1, u2 = np.random.rand(), np.random.rand()
-            omega_i = uniform_pdf.generate_dir(u1, u2)
-            samples_pos.append(omega_i)
-            samples_prob.append(uniform_pdf.get_val(omega_i))
-
-        samples_values = collect_samples(integrand, samples_pos)
-        estimate_cmc = compute_estimate_cmc(samples_prob, samples_values)
-        abs_error = abs(ground_truth - estimate_cmc)
-        errors.append(abs_error)
-        
-    # Compute the average error for the current sample count
-    results[k, 0] = np.mean(errors)
+for k, ns in enumerate(ns_vector):
+    for m, method in enumerate(methods_label):
+        print(f'{method[0]}, {ns} samples: mean error = {results[k, m]:.6f}, '
+              f'variance = {results_variance[k, m]:.6f}, RMSE = {results_rmse[k, m]:.6f}')
 
 # ################################################################################################# #
 # Create a plot with the average error for each method, as a function of the number of used samples #
@@ -0,0 +1,118 @@
+from PyRT_Common import *
+
+GP_Z_SAMPLES = 2 ** 14  # number of (Sobol) directions used to integrate the kernel in compute_z
+GP_Z_BATCH = 2 ** 12  # directions per batch when integrating the kernel
+
+
+# -------------------------------------------------Covariance functions (kernels) over the unit sphere
+class CovarianceFunction(ABC):
+    # Covariance between the directions of two (N, 3) and (M, 3) arrays, returns an (N, M) array
+    @abstractmethod
+    def eval_batch(self, dirs_a, dirs_b):
+        pass
+
+    # Covariance between two directions (Vector3D)
+    def eval(self, omega_i, omega_j):
+        return float(self.eval_batch(vector_to_array(omega_i)[np.newaxis, :], vector_to_array(omega_j)[np.newaxis, :]))
+
+    # String that identifies the kernel and its hyperparameters (used to cache the GP weights)
+    @abstractmethod
+    def get_key(self):
+        pass
+
+
+# Squared exponential kernel over the euclidean (chord) distance between directions
+class SECov(CovarianceFunction):
+    def __init__(self, l, sigma=1.0):
+        self.l = l  # length scale
+        self.sigma = sigma  # standard deviation
+
+    def eval_batch(self, dirs_a, dirs_b):
+        squared_distance = np.maximum(2.0 - 2.0 * (dirs_a @ dirs_b.T), 0.0)  # |a - b|^2 for unit vectors
+        return self.sigma ** 2 * np.exp(-squared_distance / (2.0 * self.l ** 2))
+
+    def get_key(self):
+        return 'SECov_' + repr(self.l) + '_' + repr(self.sigma)
+
+
+# Sobolev kernel of order 3/2 on the sphere: k(a, b) = 8/3 - |a - b|
+class SobolevCov(CovarianceFunction):
+    def __init__(self, sigma=1.0):
+        self.sigma = sigma  # scale (the kernel is multiplied by sigma^2)
+
+    def eval_batch(self, dirs_a, dirs_b):
+        distance = np.sqrt(np.maximum(2.0 - 2.0 * (dirs_a @ dirs_b.T), 0.0))
+        return self.sigma ** 2 * (8.0 / 3.0 - distance)
+
+    def get_key(self):
+        return 'SobolevCov_' + repr(self.sigma)
+
+
+# -------------------------------------------------Gaussian process for Bayesian Monte Carlo (BMC)
+# Models the unknown factor f of a hemispherical integral I = int f(w) p(w) dw (e.g. f = L_i, p = cos), where p is
+# a known Function (p_func) over the hemisphere around (0, 1, 0). Once the sample positions w_i are fixed, the BMC
+# estimate is a weighted sum of the sample values: I = z^T Q^-1 f = sum_i weights_i f(w_i), with Q = K + noise I
+# (K_ij = k(w_i, w_j)) and z_i = int k(w, w_i) p(w) dw. The weights only depend on the positions, so they are
+# computed once (with a Cholesky solve) and cached on disk
+class GP:
+    # Initializer
+    def __init__(self, cov_func, p_func, noise_=0.01):
+        self.cov_func = cov_func
+        self.p_func = p_func
+        self.noise = noise_
+        self.samples_pos = None  # (n, 3) array of sample directions (hemisphere around (0, 1, 0))
+        self.samples_val = None  # (n,) or (n, 3) array of sample values
+        self.weights = None  # (n,) BMC weights
+
+    # Set the sample positions and compute (or load) their BMC weights
+    def add_sample_pos(self, samples_pos_):
+        self.samples_pos = np.ascontiguousarray(samples_pos_, dtype=np.float64)
+        self.weights = cached_array(self.get_key(), self.compute_weights)
+
+    def add_sample_val(self, samples_val_):
+        self.samples_val = np.asarray(samples_val_, dtype=np.float64)
+
+    # Cache key of the weights: kernel, known function, noise and sample positions
+    def get_key(self):
+        description = (self.cov_func.get_key() + '_' + type(self.p_func).__name__ + repr(sorted(
+            (k, v) for k, v in vars(self.p_func).items() if isinstance(v, (int, float, str)))) + '_' +
+            repr(self.noise) + '_' + str(GP_Z_SAMPLES))
+        digest = hashlib.sha1(description.encode() + self.samples_pos.tobytes()).hexdigest()
+        return 'bmc_weights_' + digest
+
+    # Q = K + noise I
+    def compute_Q(self):
+        Q = self.cov_func.eval_batch(self.samples_pos, self.samples_pos)
+        Q[np.diag_indices_from(Q)] += self.noise
+        return Q
+
+    # z_i = int k(w, w_i) p(w) dw over the hemisphere, estimated with GP_Z_SAMPLES uniformly distributed Sobol
+    # directions (the same for every sample set)
+    def compute_z(self):
+        pdf = UniformPDF()
+        u = SobolSampler(scramble=None).generate(np.zeros(1), GP_Z_SAMPLES)[0]
+        z = np.zeros(len(self.samples_pos))
+        for start in range(0, GP_Z_SAMPLES, GP_Z_BATCH):
+            dirs = pdf.generate_dirs(u[start:start + GP_Z_BATCH])
+            z += self.p_func.eval_batch(dirs) @ self.cov_func.eval_batch(dirs, self.samples_pos)
+        return z * (2.0 * PI / GP_Z_SAMPLES)
+
+    # weights = Q^-1 z (Q is symmetric positive definite: two triangular solves with its Cholesky factor Q = L L^T)
+    def compute_weights(self):
+        L = np.linalg.cholesky(self.compute_Q())
+        return solve_triangular(L.T, solve_triangular(L, self.compute_z(), lower=True), lower=False)
+
+
+# Solution x of T x = b for a triangular (n, n) matrix T (lower or upper) and an (n,) vector b, by forward (lower)
+# or back (upper) substitution: O(n^2), against the O(n^3) of a general solve
+def solve_triangular(T, b, lower=True):
+    n = len(b)
+    x = np.zeros(n)
+    rows = range(n) if lower else range(n - 1, -1, -1)
+    for i in rows:
+        x[i] = (b[i] - T[i] @ x) / T[i, i]
+    return x
+
+    # BMC estimate of the integral from the sample values (one per channel if the values are (n, 3))
+    def compute_integral_BMC(self):
+        return self.weights @ self.samples_val
@@ -6,12 +6,16 @@ import os
 
 n_values = [10, 50, 100, 500]
 
-for n in n_values:
-    print(f"Generating image for n = {n}")
-    if not os.path.exists(f"out/cmc_MC_{n}_samples.png"):
-        integrator = CMCIntegrator(n, DIRECTORY + FILENAME)
-        integrator.add_scene(scene)
-        integrator.render()
+# A single progressive render saves the image of every missing n (as out/cmc_MC_{n}_samples.png); the images
+# already on disk are kept
+missing_n_values = [n for n in n_values if not os.path.exists(f"out/cmc_MC_{n}_samples.png")]
+if missing_n_values:
+    print(f"Generating images for n = {missing_n_values}")
+    integrator = CMCIntegrator(max(missing_n_values), DIRECTORY + FILENAME)
+    integrator.add_scene(scene)
+    integrator.render_progressive(missing_n_values)
+else:
+    print(f"Images for n = {n_values} found in out/, skipping the render")
 
 def rmse_error(image_path_1, image_path_2):
     image_1 = cv2.imread(image_path_1)
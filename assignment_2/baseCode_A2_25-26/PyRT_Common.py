@@ -1,9 +1,11 @@
 from math import sqrt, acos, cos, sin, atan2, floor, pi
 import cv2
-from random import random
+from random import random, seed as random_seed, getstate as random_getstate, setstate as random_setstate
 import numpy as np
 import matplotlib.pyplot as plt
 from abc import ABC, abstractmethod  # Abstract Base Class
+import hashlib
+import os
 
 # Used coordinate system: right-handed
 # Constants
@@ -12,10 +14,13 @@ HUGEVALUE = 1000000.0  # 1 million
 PI = 3.1415926535897932384
 TWO_PI = 6.2831853071795864769
 INVERTED_PI = 0.3183098861837906912
+CACHE_DIRECTORY = 'cache/'  # on-disk cache for precomputed data (see cached_array)
 
 
 # -------------------------------------------------Vector3D class
 class Vector3D:
+    __slots__ = ('x', 'y', 'z')  # no per-instance dict: smaller objects and faster attribute access
+
     # Initializer
     def __init__(self, x_element, y_element, z_element):
         self.x = x_element
@@ -41,6 +46,113 @@ class Vector3D:
     def multiply(self, v):
         return Vector3D(self.x * v.x, self.y * v.y, self.z * v.z)
 
+    # Fused helpers (a single temporary instead of one per operator)
+    # Return self + v * s
+    def madd(self, v, s):
+        return Vector3D(self.x + v.x * s, self.y + v.y * s, self.z + v.z * s)
+
+    # In-place versions: only use them on vectors owned by the caller (never on shared constants such as ONE)
+    def iadd_scaled(self, v, s):
+        self.x += v.x * s
+        self.y += v.y * s
+        self.z += v.z * s
+        return self
+
+    def normalize_in_place(self):
+        inv_length = 1.0 / sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+        self.x *= inv_length
+        self.y *= inv_length
+        self.z *= inv_length
+        return self
+
+
+# -------------------------------------------------Vec3Array class
+# N vectors stored as an (N, 3) np array. The x, y, z properties are column views, so Dot and the other free
+# functions below work unchanged on Vec3Array (with (N,) arrays where a Vector3D gives floats)
+class Vec3Array:
+    __slots__ = ('data',)
+
+    # Initializer
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=np.float64).reshape(-1, 3)
+
+    @staticmethod
+    def from_vectors(vectors):
+        return Vec3Array([(v.x, v.y, v.z) for v in vectors])
+
+    def to_vectors(self):
+        return [Vector3D(x, y, z) for x, y, z in self.data.tolist()]
+
+    @property
+    def x(self):
+        return self.data[:, 0]
+
+    @property
+    def y(self):
+        return self.data[:, 1]
+
+    @property
+    def z(self):
+        return self.data[:, 2]
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    # An integer index returns a Vector3D, anything else (slice, mask, index array) a Vec3Array
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            x, y, z = self.data[i].tolist()
+            return Vector3D(x, y, z)
+        return Vec3Array(self.data[i])
+
+    # Operator Overloading (the operand can be a Vec3Array, a Vector3D, a scalar or an (N,) array of scalars)
+    def __sub__(self, v):
+        return Vec3Array(self.data - as_vec3_operand(v))
+
+    def __add__(self, v):
+        return Vec3Array(self.data + as_vec3_operand(v))
+
+    def __mul__(self, s):
+        return Vec3Array(self.data * as_scalar_operand(s))
+
+    def __truediv__(self, s):
+        return Vec3Array(self.data / as_scalar_operand(s))
+
+    def __repr__(self):
+        return f'Vec3Array({self.data!r})'
+
+    def multiply(self, v):
+        return Vec3Array(self.data * as_vec3_operand(v))
+
+    def madd(self, v, s):
+        return Vec3Array(self.data + as_vec3_operand(v) * as_scalar_operand(s))
+
+    def iadd_scaled(self, v, s):
+        self.data += as_vec3_operand(v) * as_scalar_operand(s)
+        return self
+
+    def normalize_in_place(self):
+        self.data /= np.sqrt(np.einsum('ij,ij->i', self.data, self.data))[:, np.newaxis]
+        return self
+
+
+# Operand of an element-wise vector operation: (N, 3) array or (3,) array (broadcast)
+def as_vec3_operand(v):
+    if isinstance(v, (Vec3Array, ColorArray)):
+        return v.data
+    if isinstance(v, Vector3D):
+        return np.array([v.x, v.y, v.z])
+    if isinstance(v, RGBColor):
+        return np.array([v.r, v.g, v.b])
+    return v
+
+
+# Scalar operand: a float, or an (N,) array of per-element scalars (turned into an (N, 1) column)
+def as_scalar_operand(s):
+    if isinstance(s, np.ndarray) and s.ndim == 1:
+        return s[:, np.newaxis]
+    return s
+
 
 # Return dot product between two vectors
 def Dot(a, b):
@@ -49,27 +161,63 @@ def Dot(a, b):
 
 # Return perpendicular vector
 def Cross(a, b):
+    if isinstance(a, Vec3Array) or isinstance(b, Vec3Array):
+        return Vec3Array(np.cross(np.broadcast_to(as_vec3_operand(a), (max(len_of(a), len_of(b)), 3)),
+                                  as_vec3_operand(b)))
     return Vector3D(a.y * b.z - a.z * b.y, a.z * b.x - a.x * b.z, a.x * b.y - a.y * b.x)
 
 
 # Return length of vector
 def Length(v):
+    if isinstance(v, Vec3Array):
+        return np.sqrt(np.einsum('ij,ij->i', v.data, v.data))
     return sqrt(v.x * v.x + v.y * v.y + v.z * v.z)
 
 
 # Return normalized vector (unit vector)
 def Normalize(v):
-    return v * (1.0 / Length(v))
+    if isinstance(v, Vec3Array):
+        return Vec3Array(v.data / Length(v)[:, np.newaxis])
+    inv_length = 1.0 / sqrt(v.x * v.x + v.y * v.y + v.z * v.z)
+    return Vector3D(v.x * inv_length, v.y * inv_length, v.z * inv_length)
+
+
+# Return v * (s * Dot(a, b)) (fused dot-and-scale, e.g. the n * 2(n.l) term of a reflection): a single new
+# Vector3D, or a Vec3Array scaled per vector if any operand is a Vec3Array
+def ScaleByDot(v, a, b, s=1.0):
+    if isinstance(v, Vec3Array) or isinstance(a, Vec3Array) or isinstance(b, Vec3Array):
+        return Vec3Array(np.broadcast_to(as_vec3_operand(v), (max(len_of(v), len_of(a), len_of(b)), 3)) *
+                         as_scalar_operand(np.atleast_1d(Dot(a, b) * s)))
+    k = (a.x * b.x + a.y * b.y + a.z * b.z) * s
+    return Vector3D(v.x * k, v.y * k, v.z * k)
 
 
 # Return normal that is pointing on the side as the passed direction
 def orient_normal(normal, direction):
+    if isinstance(normal, Vec3Array) or isinstance(direction, Vec3Array):
+        sign = np.where(Dot(normal, direction) < 0.0, -1.0, 1.0)
+        return Vec3Array(np.broadcast_to(as_vec3_operand(normal), (len(sign), 3)) * sign[:, np.newaxis])
     if Dot(normal, direction) < 0.0:
         return normal * -1.0  # flip normal
     else:
         return normal
 
 
+# Number of vectors held by a Vec3Array (1 for a Vector3D)
+def len_of(v):
+    return len(v) if isinstance(v, Vec3Array) else 1
+
+
+# Convert a Vector3D to a (3,) np array
+def vector_to_array(v):
+    return np.array([v.x, v.y, v.z], dtype=np.float64)
+
+
+# Convert an RGBColor to a (3,) np array
+def color_to_array(c):
+    return np.array([c.r, c.g, c.b], dtype=np.float64)
+
+
 # -------------------------------------------------Ray class
 class Ray:
     # Initializer
@@ -85,6 +233,34 @@ class Ray:
         return self.o + self.d * t
 
 
+# -------------------------------------------------Ray packet class (structure of arrays)
+class RayPacket:
+    # Initializer
+    # origins: (N, 3) array or a single (3,) origin shared by all rays
+    # directions: (N, 3) array of normalized directions
+    # pixel_index: optional (N,) array with the flat pixel index (y * width + x) of each ray
+    def __init__(self, origins, directions, tmax=HUGEVALUE, pixel_index=None):
+        self.d = np.ascontiguousarray(directions, dtype=np.float64)
+        n_rays = self.d.shape[0]
+        self.o = np.ascontiguousarray(np.broadcast_to(origins, (n_rays, 3)), dtype=np.float64)
+        self.t_min = np.full(n_rays, EPSILON)
+        self.t_max = np.array(np.broadcast_to(tmax, (n_rays,)), dtype=np.float64)
+        self.pixel_index = pixel_index
+
+    def __len__(self):
+        return self.d.shape[0]
+
+    # Member Functions
+    def get_hitpoints(self, t):
+        return self.o + self.d * t[:, np.newaxis]
+
+    # Return the i-th ray of the packet as a scalar Ray (used by the per-ray fallback path)
+    def get_ray(self, i):
+        o = self.o[i].tolist()
+        d = self.d[i].tolist()
+        return Ray(Vector3D(o[0], o[1], o[2]), Vector3D(d[0], d[1], d[2]), float(self.t_max[i]))
+
+
 # -------------------------------------------------Structure to hold hit information
 class HitData:
     def __init__(self, has_hit=False, hit_point=Vector3D(0.0, 0.0, 0.0), normal=Vector3D(0.0, 0.0, 0.0),
@@ -97,8 +273,20 @@ class HitData:
         self.primitive_index = primitive_index  # index of the object (primitive) hit by the ray
 
 
+# -------------------------------------------------Structure to hold the hit information of a RayPacket
+class BatchHitData:
+    def __init__(self, n_rays):
+        self.has_hit = np.zeros(n_rays, dtype=bool)  # (N,) whether or not each ray hit something
+        self.hit_point = np.zeros((n_rays, 3))  # (N, 3) hit points
+        self.normal = np.zeros((n_rays, 3))  # (N, 3) normals at the surface
+        self.hit_distance = np.full(n_rays, HUGEVALUE)  # (N,) intersection distances along the rays
+        self.primitive_index = np.full(n_rays, -1)  # (N,) index of the object (primitive) hit by each ray
+
+
 # -------------------------------------------------RGBColour class
 class RGBColor:
+    __slots__ = ('r', 'g', 'b')
+
     # Initializer
     def __init__(self, red, green, blue):
         self.r = red
@@ -122,6 +310,22 @@ class RGBColor:
     def multiply(self, c):
         return RGBColor(self.r * c.r, self.g * c.g, self.b * c.b)
 
+    # Fused helpers (a single temporary instead of one per operator)
+    # Return self * c * s (e.g. l_i * brdf * cos / pdf)
+    def multiply_scaled(self, c, s):
+        return RGBColor(self.r * c.r * s, self.g * c.g * s, self.b * c.b * s)
+
+    # Return self + c * s
+    def madd(self, c, s):
+        return RGBColor(self.r + c.r * s, self.g + c.g * s, self.b + c.b * s)
+
+    # In-place accumulation: only use it on colors owned by the caller (never on shared constants such as BLACK)
+    def iadd_scaled(self, c, s=1.0):
+        self.r += c.r * s
+        self.g += c.g * s
+        self.b += c.b * s
+        return self
+
     # Member Functions
     def clamp(self, minimum, maximum):
         # red
@@ -138,6 +342,83 @@ class RGBColor:
         return f'RGBColor({self.r}, {self.g}, {self.b})'
 
 
+# -------------------------------------------------ColorArray class
+# N colors stored as an (N, 3) np array, with r, g, b column views (the array counterpart of RGBColor)
+class ColorArray:
+    __slots__ = ('data',)
+
+    # Initializer
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=np.float64).reshape(-1, 3)
+
+    @staticmethod
+    def from_colors(colors):
+        return ColorArray([(c.r, c.g, c.b) for c in colors])
+
+    def to_colors(self):
+        return [RGBColor(r, g, b) for r, g, b in self.data.tolist()]
+
+    @property
+    def r(self):
+        return self.data[:, 0]
+
+    @property
+    def g(self):
+        return self.data[:, 1]
+
+    @property
+    def b(self):
+        return self.data[:, 2]
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    # An integer index returns an RGBColor, anything else (slice, mask, index array) a ColorArray
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            r, g, b = self.data[i].tolist()
+            return RGBColor(r, g, b)
+        return ColorArray(self.data[i])
+
+    # Operator Overloading (the operand can be a ColorArray, an RGBColor, a scalar or an (N,) array of scalars)
+    def __add__(self, c):
+        return ColorArray(self.data + as_vec3_operand(c))
+
+    def __sub__(self, c):
+        return ColorArray(self.data - as_vec3_operand(c))
+
+    def __mul__(self, s):
+        return ColorArray(self.data * as_scalar_operand(s))
+
+    def __truediv__(self, s):
+        return ColorArray(self.data / as_scalar_operand(s))
+
+    def multiply(self, c):
+        return ColorArray(self.data * as_vec3_operand(c))
+
+    def multiply_scaled(self, c, s):
+        return ColorArray(self.data * as_vec3_operand(c) * as_scalar_operand(s))
+
+    def madd(self, c, s):
+        return ColorArray(self.data + as_vec3_operand(c) * as_scalar_operand(s))
+
+    def iadd_scaled(self, c, s=1.0):
+        self.data += as_vec3_operand(c) * as_scalar_operand(s)
+        return self
+
+    # Sum of all the colors (an RGBColor)
+    def sum(self):
+        r, g, b = self.data.sum(axis=0).tolist()
+        return RGBColor(r, g, b)
+
+    # Member Functions
+    def clamp(self, minimum, maximum):
+        np.clip(self.data, minimum, maximum, out=self.data)
+
+    def __repr__(self):
+        return f'ColorArray({self.data!r})'
+
+
 # Constants
 BLACK = RGBColor(0.0, 0.0, 0.0)
 WHITE = RGBColor(1.0, 1.0, 1.0)
@@ -148,14 +429,6 @@ ONE = Vector3D(1, 1, 1)
 
 
 # ------------------------------------------------- Free Functions
-# Return normal that is pointing on the side as the passed direction
-def orient_normal(normal, direction):
-    if Dot(normal, direction) < 0.0:
-        return normal * -1.0  # flip normal
-    else:
-        return normal
-
-
 # Convert a point set defined on the unit sphere from euclidean coordinates (3D) to 2D polar coordinates (disk)
 # Returns two np arrays
 def euclidean_to_disk(sample_set):
@@ -172,7 +445,335 @@ def euclidean_to_disk(sample_set):
     return r, phi
 
 
-def sample_set_hemisphere(n_samples, pdf):
+# Seed the random number generators used for sampling (python's random module and numpy's global generator)
+def seed_rngs(seed_value):
+    random_seed(seed_value)
+    np.random.seed(seed_value)
+
+
+# State of both random number generators as a JSON serializable dict (see set_rng_state)
+def get_rng_state():
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    version, internal_state, gauss_next = random_getstate()
+    return {'numpy': [name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)],
+            'python': [version, list(internal_state), gauss_next]}
+
+
+# Restore the random number generators to a state returned by get_rng_state
+def set_rng_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    version, internal_state, gauss_next = state['python']
+    random_setstate((version, tuple(internal_state), gauss_next))
+
+
+# -------------------------------------------------Counter-based random numbers (Philox4x32-10)
+# Philox (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3") maps a 128-bit counter and a 64-bit key
+# to 128 random bits with 10 rounds of multiplications and xors, so any random number can be computed directly
+# from its coordinates, in any order and in any process. Implemented on uint64 arrays (the 32x32-bit products
+# give the high and low words)
+PHILOX_M0 = 0xD2511F53  # round multipliers
+PHILOX_M1 = 0xCD9E8D57
+PHILOX_W0 = 0x9E3779B9  # key increments (Weyl sequence)
+PHILOX_W1 = 0xBB67AE85
+PHILOX_ROUNDS = 10
+UINT32_MASK = 0xFFFFFFFF
+UINT32_TO_UNIT = 2.0 ** -32  # maps a uint32 to [0, 1)
+
+
+# counters: (..., 4) array of uint32 words, key: (..., 2) array of uint32 words (broadcast against counters)
+# Returns the (..., 4) uint32 array of random words
+def philox4x32(counters, key):
+    c0, c1, c2, c3 = (counters[..., i].astype(np.uint64) for i in range(4))
+    k0 = key[..., 0].astype(np.uint64)
+    k1 = key[..., 1].astype(np.uint64)
+    for r in range(PHILOX_ROUNDS):
+        p0 = c0 * np.uint64(PHILOX_M0)
+        p1 = c2 * np.uint64(PHILOX_M1)
+        c0, c1, c2, c3 = ((p1 >> np.uint64(32)) ^ c1 ^ k0, p1 & np.uint64(UINT32_MASK),
+                          (p0 >> np.uint64(32)) ^ c3 ^ k1, p0 & np.uint64(UINT32_MASK))
+        k0 = (k0 + np.uint64(PHILOX_W0)) & np.uint64(UINT32_MASK)
+        k1 = (k1 + np.uint64(PHILOX_W1)) & np.uint64(UINT32_MASK)
+    return np.stack([c0, c1, c2, c3], axis=-1).astype(np.uint32)
+
+
+# Reproducible random number streams: stream s (e.g. a pixel index) of a given seed is keyed by (s, seed) and
+# its random number (sample j, dimension d) comes from the counter (j, d // 4, high bits of s, 0), word d % 4.
+# The numbers of a sample are the same whichever order, batch or process they are generated in
+class RandomStreams:
+    # Initializer
+    def __init__(self, seed=0):
+        self.seed = int(seed) & UINT32_MASK
+
+    # Random uint32 words of samples [sample_start, sample_start + n_samples) and dimensions [0, n_dims) of each
+    # stream in stream_ids ((N,) array of non-negative ints)
+    # Returns an (N, n_samples, n_dims) array (generated in blocks of 4 dimensions)
+    def uint32(self, stream_ids, n_samples, n_dims=2, sample_start=0):
+        stream_ids = np.asarray(stream_ids, dtype=np.uint64).reshape(-1)
+        n_blocks = (n_dims + 3) // 4
+        counters = np.zeros((len(stream_ids), n_samples, n_blocks, 4), dtype=np.uint64)
+        counters[..., 0] = (sample_start + np.arange(n_samples, dtype=np.uint64))[np.newaxis, :, np.newaxis]
+        counters[..., 1] = np.arange(n_blocks, dtype=np.uint64)
+        counters[..., 2] = (stream_ids >> np.uint64(32))[:, np.newaxis, np.newaxis]
+        key = np.empty((len(stream_ids), 1, 1, 2), dtype=np.uint64)
+        key[:, 0, 0, 0] = stream_ids & np.uint64(UINT32_MASK)
+        key[:, 0, 0, 1] = self.seed
+        words = philox4x32(counters, key).reshape((len(stream_ids), n_samples, 4 * n_blocks))
+        return words[..., :n_dims]
+
+    # Uniform random numbers in [0, 1), same layout as uint32
+    def uniform(self, stream_ids, n_samples, n_dims=2, sample_start=0):
+        return self.uint32(stream_ids, n_samples, n_dims, sample_start) * UINT32_TO_UNIT
+
+
+# -------------------------------------------------Alias table (Walker's alias method, built with Vose's algorithm)
+# O(1) sampling of a discrete distribution over n entries, proportional to non-negative weights: a uniform number
+# picks a column i and its fraction selects either i (with probability prob[i]) or its alias
+class AliasTable:
+    # Initializer
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        total = weights.sum()
+        if len(weights) == 0 or not total > 0.0:
+            raise ValueError('An alias table needs at least one positive weight')
+        n = len(weights)
+        self.pdf = weights / total  # probability of each entry
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        scaled = self.pdf * n
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] += scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # the entries left (in either list) have scaled weight 1 up to rounding errors and keep prob 1
+
+    def __len__(self):
+        return len(self.prob)
+
+    # Entry chosen by each uniform random number of u (float or np array of any shape)
+    def sample(self, u):
+        x = np.asarray(u, dtype=np.float64) * len(self.prob)
+        column = np.minimum(x.astype(np.int64), len(self.prob) - 1)
+        return np.where(x - column < self.prob[column], column, self.alias[column])
+
+
+# -------------------------------------------------Samplers
+# A sampler generates point sets in [0, 1)^n_dims, used wherever uniform random numbers (u1, u2) are consumed
+# (PDF.generate_dirs, EnvironmentMap.sample_batch, ...). Point set s is e.g. the set of a pixel or of an estimate
+# and sample_start + j is the index of a point in its set
+class Sampler(ABC):
+    # Return the (len(set_ids), n_samples, n_dims) array with the points [sample_start, sample_start + n_samples)
+    # of each point set in set_ids ((N,) array of non-negative ints)
+    @abstractmethod
+    def generate(self, set_ids, n_samples, n_dims=2, sample_start=0):
+        pass
+
+
+# Independent uniform random numbers (from RandomStreams)
+class IndependentSampler(Sampler):
+    def __init__(self, seed=0):
+        self.streams = RandomStreams(seed)
+
+    def generate(self, set_ids, n_samples, n_dims=2, sample_start=0):
+        return self.streams.uniform(set_ids, n_samples, n_dims, sample_start)
+
+
+# Stratified (jittered) sampling: each pair of dimensions (0, 1), (2, 3), ... is split into an nx x ny grid
+# of strata (nx * ny = n, as square as possible) with one jittered point per stratum, and the strata are
+# shuffled independently for each pair of dimensions. When n is prime the grid would be 1 x n (only one dimension
+# stratified), so Latin hypercube sampling is used instead: every dimension is split into n strata, each with its
+# own shuffle
+# n_total: number of samples of each point set stratified together. The stratum of a sample is chosen by its
+# absolute number (sample_start + its index), so the points of several calls that cover [0, n_total) (e.g. the
+# passes of CMCIntegrator.render_progressive) form a single stratified set. None: n = n_samples, the points of
+# each call are stratified on their own
+class StratifiedSampler(Sampler):
+    def __init__(self, seed=0, n_total=None):
+        self.seed = seed
+        self.n_total = n_total
+        self.jitter_streams = RandomStreams(seed)
+        self.shuffle_streams = RandomStreams(seed + 1)
+
+    # Same sampler, stratifying n_total samples per point set
+    def for_total(self, n_total):
+        return StratifiedSampler(self.seed, n_total)
+
+    def generate(self, set_ids, n_samples, n_dims=2, sample_start=0):
+        n_sets = len(set_ids)
+        n = n_samples if self.n_total is None else self.n_total
+        first = 0 if self.n_total is None else sample_start  # first stratum (in shuffled order) of the call
+        key_start = sample_start if self.n_total is None else 0  # the shuffles of the n_total strata are shared
+        if first + n_samples > n:
+            raise ValueError('StratifiedSampler: samples [' + str(sample_start) + ', ' +
+                             str(sample_start + n_samples) + ') exceed n_total = ' + str(n))
+        nx = int(floor(sqrt(n)))
+        while n % nx != 0:
+            nx -= 1
+        ny = n // nx
+        jitter = self.jitter_streams.uniform(set_ids, n_samples, n_dims, sample_start)
+        points = np.empty((n_sets, n_samples, n_dims))
+        if nx == 1 and n > 1:
+            # Latin hypercube: (n_sets, n_samples) stratum of each point in each dimension
+            shuffle_keys = self.shuffle_streams.uniform(set_ids, n, n_dims, key_start)
+            order = np.argsort(shuffle_keys, axis=1)[:, first:first + n_samples, :]
+            return (order + jitter) / n
+        j = np.arange(n)
+        strata = np.stack([(j % nx) / nx, (j // nx) / ny], axis=-1)  # (n, 2) lower corners
+        shuffle_keys = self.shuffle_streams.uniform(set_ids, n, (n_dims + 1) // 2, key_start)
+        for pair in range(0, n_dims, 2):
+            dims = min(2, n_dims - pair)
+            order = np.argsort(shuffle_keys[..., pair // 2], axis=1)[:, first:first + n_samples]
+            points[..., pair:pair + dims] = strata[order][..., :dims] + \
+                jitter[..., pair:pair + dims] * np.array([1.0 / nx, 1.0 / ny])[:dims]
+        return points
+
+
+# Radical inverse of the integer array i in the given base
+def radical_inverse(i, base):
+    i = np.array(i, dtype=np.int64)
+    result = np.zeros(i.shape)
+    inv_base_power = 1.0 / base
+    while np.any(i > 0):
+        result += (i % base) * inv_base_power
+        i //= base
+        inv_base_power /= base
+    return result
+
+
+HALTON_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53]
+
+
+# Halton sequence (dimension d is the radical inverse in base HALTON_PRIMES[d]). It is deterministic: every point
+# set is the same sequence, randomize it with CranleyPattersonSampler
+class HaltonSampler(Sampler):
+    def generate(self, set_ids, n_samples, n_dims=2, sample_start=0):
+        if n_dims > len(HALTON_PRIMES):
+            raise ValueError('HaltonSampler supports up to ' + str(len(HALTON_PRIMES)) + ' dimensions')
+        i = sample_start + np.arange(n_samples)
+        points = np.stack([radical_inverse(i, HALTON_PRIMES[d]) for d in range(n_dims)], axis=-1)
+        return np.broadcast_to(points, (len(set_ids), n_samples, n_dims)).copy()
+
+
+# Sobol direction numbers from Joe and Kuo (new-joe-kuo-6.21201), for the dimensions after the first
+# (the first dimension is the van der Corput sequence): (degree s, coefficients a, initial numbers m)
+SOBOL_JOE_KUO = [(1, 0, [1]),
+                 (2, 1, [1, 3]),
+                 (3, 1, [1, 3, 1]),
+                 (3, 2, [1, 1, 1]),
+                 (4, 1, [1, 1, 3, 3]),
+                 (4, 4, [1, 3, 5, 13]),
+                 (5, 2, [1, 1, 5, 5, 17])]
+SOBOL_BITS = 32
+
+
+# Direction numbers (SOBOL_BITS,) uint32 array of a Sobol dimension
+def sobol_direction_numbers(dimension):
+    v = np.zeros(SOBOL_BITS, dtype=np.uint64)
+    if dimension == 0:
+        for k in range(SOBOL_BITS):
+            v[k] = 1 << (SOBOL_BITS - 1 - k)
+        return v.astype(np.uint32)
+    s, a, m = SOBOL_JOE_KUO[dimension - 1]
+    for k in range(SOBOL_BITS):
+        if k < s:
+            v[k] = m[k] << (SOBOL_BITS - 1 - k)
+        else:
+            v[k] = v[k - s] ^ (v[k - s] >> np.uint64(s))
+            for i in range(1, s):
+                if (a >> (s - 1 - i)) & 1:
+                    v[k] ^= v[k - i]
+    return v.astype(np.uint32)
+
+
+# Reverse the bits of a uint32 array
+def reverse_bits_uint32(x):
+    x = x.astype(np.uint32)
+    x = ((x >> np.uint32(1)) & np.uint32(0x55555555)) | ((x & np.uint32(0x55555555)) << np.uint32(1))
+    x = ((x >> np.uint32(2)) & np.uint32(0x33333333)) | ((x & np.uint32(0x33333333)) << np.uint32(2))
+    x = ((x >> np.uint32(4)) & np.uint32(0x0F0F0F0F)) | ((x & np.uint32(0x0F0F0F0F)) << np.uint32(4))
+    x = ((x >> np.uint32(8)) & np.uint32(0x00FF00FF)) | ((x & np.uint32(0x00FF00FF)) << np.uint32(8))
+    return (x >> np.uint32(16)) | (x << np.uint32(16))
+
+
+# Owen (nested uniform) scrambling of uint32 arrays with the Laine-Karras hash (Burley, "Practical Hash-based
+# Owen Scrambling"): the hash only propagates bits upwards, so applied to the reversed bits every digit is
+# permuted depending on the digits above it
+def owen_scramble_uint32(x, seeds):
+    x = reverse_bits_uint32(x)
+    x = x + seeds
+    x ^= x * np.uint32(0x6C50B47C)
+    x ^= x * np.uint32(0xB82F1E52)
+    x ^= x * np.uint32(0xC7AFE638)
+    x ^= x * np.uint32(0x8D22F6E6)
+    return reverse_bits_uint32(x)
+
+
+# Sobol sequence, scrambled per point set and dimension:
+# scramble='owen' (nested uniform scrambling), 'xor' (random digit scrambling) or None (deterministic)
+class SobolSampler(Sampler):
+    def __init__(self, seed=0, scramble='owen'):
+        if scramble not in ('owen', 'xor', None):
+            raise ValueError('Unknown Sobol scrambling: ' + str(scramble))
+        self.scramble = scramble
+        self.scramble_streams = RandomStreams(seed)
+        self.direction_numbers = [sobol_direction_numbers(d) for d in range(len(SOBOL_JOE_KUO) + 1)]
+
+    def generate(self, set_ids, n_samples, n_dims=2, sample_start=0):
+        if n_dims > len(self.direction_numbers):
+            raise ValueError('SobolSampler supports up to ' + str(len(self.direction_numbers)) + ' dimensions')
+        i = (sample_start + np.arange(n_samples)).astype(np.uint64)
+        points = np.zeros((n_samples, n_dims), dtype=np.uint32)
+        for k in range(SOBOL_BITS):
+            bit = ((i >> np.uint64(k)) & np.uint64(1)).astype(bool)
+            if not np.any(bit):
+                continue
+            for d in range(n_dims):
+                points[bit, d] ^= self.direction_numbers[d][k]
+        points = np.broadcast_to(points, (len(set_ids), n_samples, n_dims))
+        if self.scramble is not None:
+            seeds = self.scramble_streams.uint32(set_ids, 1, n_dims)  # (N, 1, n_dims), one seed per set and dimension
+            if self.scramble == 'owen':
+                points = owen_scramble_uint32(points, seeds)
+            else:
+                points = points ^ seeds
+        return points * UINT32_TO_UNIT
+
+
+# Cranley-Patterson rotation: the points of another sampler are shifted (modulo 1) by a random offset per point
+# set and dimension, which randomizes deterministic sequences like Halton
+class CranleyPattersonSampler(Sampler):
+    def __init__(self, sampler, seed=0):
+        self.sampler = sampler
+        self.offset_streams = RandomStreams(seed)
+
+    def generate(self, set_ids, n_samples, n_dims=2, sample_start=0):
+        offsets = self.offset_streams.uniform(set_ids, 1, n_dims)  # (N, 1, n_dims)
+        points = self.sampler.generate(set_ids, n_samples, n_dims, sample_start) + offsets
+        return points - np.floor(points)
+
+
+# Generate n_samples directions over the hemisphere with the given pdf, and their probabilities
+# With as_array=True they are generated in one batch and returned as an (n_samples, 3) and an (n_samples,) array
+# If a sampler is given, the (u1, u2) pairs are the points of its point set set_id (instead of random numbers)
+def sample_set_hemisphere(n_samples, pdf, as_array=False, sampler=None, set_id=0):
+    if sampler is not None:
+        u = sampler.generate(np.array([set_id]), n_samples)[0]
+        sample_set = pdf.generate_dirs(u)
+        if as_array:
+            return sample_set, pdf.get_vals(sample_set)
+        sample_set = [Vector3D(x, y, z) for x, y, z in sample_set.tolist()]
+        return sample_set, [pdf.get_val(omega_i) for omega_i in sample_set]
+    if as_array:
+        sample_set = pdf.generate_dirs(np.random.rand(n_samples, 2))
+        return sample_set, pdf.get_vals(sample_set)
     sample_set = []
     sample_prob = []
     for i in range(n_samples):
@@ -217,39 +818,425 @@ def rotate_around_y(alpha, dir_):
 
 
 def center_around_normal(dir, normal):
-    # create orthonormal basis around normal
-    w = normal
-    v = Cross(Vector3D(0.00319, 1.0, 0.0078), w)  # jittered up
-    v = Normalize(v)  # normalize
-    u = Cross(v, w)
+    return Frame(normal).to_world(dir)
+
+
+# -------------------------------------------------Orthonormal frame around a normal
+# Local space is the one of the hemisphere PDFs: the normal is the local y axis
+# Build it once per shading point and reuse it for all its samples (planar primitives cache theirs, see get_frame)
+JITTERED_UP = Vector3D(0.00319, 1.0, 0.0078)
+
 
-    hemi_dir = (v * dir.x) + (w * dir.y) + (u * dir.z)  # project the original direction dir onto the new frame
-    return Normalize(hemi_dir)
+class Frame:
+    __slots__ = ('u', 'v', 'w', 'matrix')
+
+    # Initializer
+    def __init__(self, normal):
+        # create orthonormal basis around normal
+        self.w = normal
+        self.v = Normalize(Cross(JITTERED_UP, normal))
+        self.u = Cross(self.v, normal)
+        # rows: world space images of the local x, y and z axes
+        self.matrix = np.array([[self.v.x, self.v.y, self.v.z],
+                                [self.w.x, self.w.y, self.w.z],
+                                [self.u.x, self.u.y, self.u.z]])
+
+    # Local direction (Vector3D) to world space
+    def to_world(self, dir):
+        hemi_dir = (self.v * dir.x).iadd_scaled(self.w, dir.y).iadd_scaled(self.u, dir.z)
+        return hemi_dir.normalize_in_place()
+
+    # (N, 3) array of local directions to world space
+    def to_world_batch(self, dirs):
+        world = dirs @ self.matrix
+        return world / np.linalg.norm(world, axis=-1, keepdims=True)
+
+    # World direction (Vector3D) to local space
+    def to_local(self, dir):
+        return Vector3D(Dot(dir, self.v), Dot(dir, self.w), Dot(dir, self.u))
+
+    # (N, 3) array of world directions to local space
+    def to_local_batch(self, dirs):
+        return dirs @ self.matrix.T
+
+
+# -------------------------------------------------Orthonormal frames around N normals
+class FrameBatch:
+    # Initializer (normals is an (N, 3) array of unit normals)
+    def __init__(self, normals):
+        w = np.asarray(normals, dtype=np.float64)
+        v = np.cross(vector_to_array(JITTERED_UP), w)
+        v /= np.linalg.norm(v, axis=1, keepdims=True)
+        u = np.cross(v, w)
+        self.matrix = np.stack([v, w, u], axis=1)  # (N, 3, 3), row i of frame n is the local axis i
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    # Local directions to world space: dirs is (N, 3) (one direction per frame) or (N, M, 3) (M per frame)
+    def to_world(self, dirs):
+        if dirs.ndim == 2:
+            world = np.einsum('ni,nij->nj', dirs, self.matrix)
+        else:
+            world = np.einsum('nmi,nij->nmj', dirs, self.matrix)
+        return world / np.linalg.norm(world, axis=-1, keepdims=True)
+
+    # World directions ((N, 3) or (N, M, 3)) to local space
+    def to_local(self, dirs):
+        if dirs.ndim == 2:
+            return np.einsum('nj,nij->ni', dirs, self.matrix)
+        return np.einsum('nmj,nij->nmi', dirs, self.matrix)
+
+
+# Return the array stored in the on-disk cache under key, computing (and storing) it if it is not cached yet
+def cached_array(key, compute):
+    path = os.path.join(CACHE_DIRECTORY, key + '.npy')
+    if os.path.exists(path):
+        return np.load(path)
+    value = np.asarray(compute())
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, value)
+    os.replace(temp_path, path)  # atomic, so concurrent processes never read a partial file
+    return value
+
+
+# Luminance of an array of RGB values (last axis)
+def luminance_array(rgb):
+    return 0.2126 * rgb[..., 0] + 0.7152 * rgb[..., 1] + 0.0722 * rgb[..., 2]
+
+
+# -------------------------------------------------Real spherical harmonics
+# Orthonormal real SH basis up to band 3, Y_lm in the order (l, m) = (0, 0), (1, -1), (1, 0), (1, 1), (2, -2), ...
+# An SH expansion of order k uses the bands 0..k: (k + 1)^2 coefficients
+SH_MAX_ORDER = 3
+SH_PROJECTION_BATCH = 2 ** 16  # texels per batch when projecting an environment map
+
+
+# (N, (order + 1)^2) values of the SH basis at (N, 3) unit directions
+def sh_basis(dirs, order=2):
+    if order > SH_MAX_ORDER:
+        raise ValueError('Spherical harmonics are implemented up to order ' + str(SH_MAX_ORDER))
+    x, y, z = dirs[:, 0], dirs[:, 1], dirs[:, 2]
+    basis = [np.full(len(dirs), 0.282094791773878)]
+    if order >= 1:
+        basis += [0.488602511902920 * y, 0.488602511902920 * z, 0.488602511902920 * x]
+    if order >= 2:
+        basis += [1.092548430592079 * x * y, 1.092548430592079 * y * z, 0.315391565252520 * (3.0 * z * z - 1.0),
+                  1.092548430592079 * x * z, 0.546274215296040 * (x * x - y * y)]
+    if order >= 3:
+        basis += [0.590043589926644 * y * (3.0 * x * x - y * y), 2.890611442640554 * x * y * z,
+                  0.457045799464466 * y * (5.0 * z * z - 1.0), 0.373176332590115 * z * (5.0 * z * z - 3.0),
+                  0.457045799464466 * x * (5.0 * z * z - 1.0), 1.445305721320277 * z * (x * x - y * y),
+                  0.590043589926644 * x * (x * x - 3.0 * y * y)]
+    return np.stack(basis, axis=-1)
+
+
+# Coefficients A_l of the clamped cosine max(0, cos theta) in the SH basis, repeated for the 2l + 1 coefficients of
+# each band (Ramamoorthi and Hanrahan, "An Efficient Representation for Irradiance Environment Maps"):
+# pi, 2 pi / 3, pi / 4, 0 (odd bands above 1 vanish)
+def sh_cosine_lobe(order=2):
+    lobe = np.array([PI, 2.0 * PI / 3.0, PI / 4.0, 0.0])[:order + 1]
+    return np.repeat(lobe, 2 * np.arange(order + 1) + 1)
 
 
 # -------------------------------------------------Environment Map Source Class
+ENV_MAP_LOOKUP_MODES = ('nearest', 'bilinear')  # texel filtering of EnvironmentMap.lookup
+ENV_MAP_IRRADIANCE_WIDTH = 64  # lat-long resolution of the cosine-prefiltered irradiance map
+ENV_MAP_IRRADIANCE_HEIGHT = 32
+ENV_MAP_IRRADIANCE_SOURCE_WIDTH = 256  # the irradiance is integrated over a mip level at most this wide
+ENV_MAP_IRRADIANCE_BATCH = 2 ** 12  # source texels per batch when integrating the irradiance map
+
+
 class EnvironmentMap:
     # Initializer
-    def __init__(self, env_map_path):
+    # lookup_mode: default filtering of lookup (and of getValue), 'nearest' or 'bilinear'
+    def __init__(self, env_map_path, lookup_mode='nearest'):
+        if lookup_mode not in ENV_MAP_LOOKUP_MODES:
+            raise ValueError('Unknown environment map lookup mode: ' + str(lookup_mode))
+        self.lookup_mode = lookup_mode
         # IMREAD_ANYDEPTH is needed because even though the data is stored in 8-bit channels
         # when it's read into memory it's represented at a higher bit depth
         self.env_map_hdr = cv2.imread(env_map_path, flags=cv2.IMREAD_ANYDEPTH | cv2.IMREAD_COLOR)
-        self.env_map_hdr = cv2.cvtColor(self.env_map_hdr, cv2.COLOR_RGB2BGR)
+        # (height, width, 3) contiguous float32 array, and a flat (height * width, 3) view of it for the gathers
+        self.env_map_hdr = np.ascontiguousarray(cv2.cvtColor(self.env_map_hdr, cv2.COLOR_RGB2BGR), dtype=np.float32)
+        self.texels = self.env_map_hdr.reshape(-1, 3)
         self.height = self.env_map_hdr.shape[0]
         self.width = self.env_map_hdr.shape[1]
+        self.mip_levels = None  # mip pyramid, built on first use (see get_mip_levels)
+        self.irradiance_map = None  # cosine-prefiltered irradiance map, built on first use (see get_irradiance_map)
+        with open(env_map_path, 'rb') as f:
+            self.content_hash = hashlib.sha1(f.read()).hexdigest()  # key of the precomputed data in the cache
+        self.build_sampling_distribution()
 
     def euclideanToLatLong(self, d):
         uLatLong = (1 + (1 / PI) * atan2(d.x, -d.z)) / 2.0
         vLatLong = (1 / PI) * acos(d.y)
         return (uLatLong, vLatLong)
 
+    # Batched version of euclideanToLatLong: (N, 3) directions to two (N,) arrays u, v
+    def euclidean_to_latlong_batch(self, dirs):
+        u = (1 + (1 / PI) * np.arctan2(dirs[:, 0], -dirs[:, 2])) / 2.0
+        v = (1 / PI) * np.arccos(np.clip(dirs[:, 1], -1.0, 1.0))
+        return u, v
+
+    # Inverse of euclidean_to_latlong_batch: two (N,) arrays u, v to (N, 3) directions
+    def latlong_to_euclidean_batch(self, u, v):
+        phi = PI * (2.0 * u - 1.0)
+        theta = PI * v
+        sin_theta = np.sin(theta)
+        return np.stack((sin_theta * np.sin(phi), np.cos(theta), -sin_theta * np.cos(phi)), axis=1)
+
     def getValue(self, d):
+        if self.lookup_mode != 'nearest':
+            res = self.lookup(np.array([[d.x, d.y, d.z]]))[0].tolist()
+            return RGBColor(res[0], res[1], res[2])
         (u, v) = self.euclideanToLatLong(d)
         tx = floor(u * (self.width - 1))  # texel x coordinate
         ty = floor(v * (self.height - 1))  # texel y coordinate
         res = self.env_map_hdr[ty, tx, :]
         return RGBColor(res[0], res[1], res[2])
 
+    # Batched version of getValue: (N, 3) directions to an (N, 3) float32 array of RGB values
+    # mode: 'nearest' (the texel of getValue) or 'bilinear', None for the lookup_mode of the map
+    # level: mip level (see get_mip_levels), one for all the directions or an (N,) array, fractional levels blend
+    # the two nearest ones (trilinear filtering with mode='bilinear'); level_for_solid_angle gives the level that
+    # matches the footprint of a sample
+    def lookup(self, dirs, mode=None, level=0.0):
+        if mode is None:
+            mode = self.lookup_mode
+        if mode not in ENV_MAP_LOOKUP_MODES:
+            raise ValueError('Unknown environment map lookup mode: ' + str(mode))
+        u, v = self.euclidean_to_latlong_batch(dirs)
+        if np.all(np.asarray(level) <= 0.0):
+            return self.fetch(self.env_map_hdr, u, v, mode)
+        levels = self.get_mip_levels()
+        level = np.clip(np.broadcast_to(level, u.shape), 0.0, len(levels) - 1)
+        lower = np.floor(level).astype(np.int64)
+        t = (level - lower).astype(np.float32)[:, np.newaxis]
+        values = np.zeros((len(u), 3), dtype=np.float32)
+        for k in np.unique(lower):  # one fetch per level (and the next one) used by the directions
+            chosen = np.flatnonzero(lower == k)
+            values[chosen] = self.fetch(levels[k], u[chosen], v[chosen], mode, k > 0)
+            if k + 1 < len(levels):
+                values[chosen] = values[chosen] * (1.0 - t[chosen]) + \
+                    self.fetch(levels[k + 1], u[chosen], v[chosen], mode, True) * t[chosen]
+        return values
+
+    # Texels of a lat-long (height, width, 3) image at the coordinates (u, v)
+    # The nearest texels of the map follow getValue (u * (width - 1)); with centered=True (the mip levels, where
+    # that would skew the lookups by up to a whole coarse texel) they are the texels whose cell contains (u, v)
+    @staticmethod
+    def fetch(image, u, v, mode, centered=False):
+        height, width = image.shape[:2]
+        texels = image.reshape(-1, 3)
+        if mode == 'nearest':
+            if centered:
+                tx = np.minimum(np.floor(u * width), width - 1).astype(np.int64)
+                ty = np.minimum(np.floor(v * height), height - 1).astype(np.int64)
+            else:
+                tx = np.floor(u * (width - 1)).astype(np.int64)  # texel x coordinates
+                ty = np.floor(v * (height - 1)).astype(np.int64)  # texel y coordinates
+            return np.take(texels, ty * width + tx, axis=0)
+        return EnvironmentMap.fetch_bilinear(texels, width, height, u, v)
+
+    # Bilinear interpolation of the (height * width, 3) texels at the lat-long coordinates (u, v), with texel (x, y)
+    # centered at ((x + 0.5) / width, (y + 0.5) / height): the columns wrap around at the u seam (phi = +-pi) and
+    # the rows are clamped at the poles
+    @staticmethod
+    def fetch_bilinear(texels, width, height, u, v):
+        x = u * width - 0.5
+        y = np.clip(v * height - 0.5, 0.0, height - 1)
+        x0 = np.floor(x)
+        y0 = np.minimum(np.floor(y), max(height - 2, 0))
+        fx = (x - x0).astype(np.float32)[:, np.newaxis]
+        fy = (y - y0).astype(np.float32)[:, np.newaxis]
+        x0 = x0.astype(np.int64) % width
+        x1 = (x0 + 1) % width
+        row0 = y0.astype(np.int64) * width
+        row1 = np.minimum(row0 + width, (height - 1) * width)
+        top = np.take(texels, row0 + x0, axis=0) * (1.0 - fx) + np.take(texels, row0 + x1, axis=0) * fx
+        bottom = np.take(texels, row1 + x0, axis=0) * (1.0 - fx) + np.take(texels, row1 + x1, axis=0) * fx
+        return top * (1.0 - fy) + bottom * fy
+
+    # Mip pyramid: level 0 is the map and level k + 1 averages the 2 x 2 texels of level k, down to 1 x 1 texel
+    # Returns the list of (height_k, width_k, 3) float32 arrays. The levels are computed once and stored in the
+    # on-disk cache as one flat array (keyed by the file content)
+    def get_mip_levels(self):
+        if self.mip_levels is None:
+            shapes = self.mip_shapes()
+            flat = cached_array(self.content_hash + '_mip_pyramid', lambda: self.compute_mip_pyramid(shapes))
+            self.mip_levels = [self.env_map_hdr]
+            offset = 0
+            for height, width in shapes[1:]:
+                self.mip_levels.append(flat[offset:offset + height * width * 3].reshape((height, width, 3)))
+                offset += height * width * 3
+        return self.mip_levels
+
+    # (height, width) of each mip level
+    def mip_shapes(self):
+        shapes = [(self.height, self.width)]
+        while shapes[-1] != (1, 1):
+            height, width = shapes[-1]
+            shapes.append((max(1, height // 2), max(1, width // 2)))
+        return shapes
+
+    def compute_mip_pyramid(self, shapes):
+        levels = [np.zeros(0, dtype=np.float32)]
+        level = self.env_map_hdr
+        for height, width in shapes[1:]:
+            level = cv2.resize(level, (width, height), interpolation=cv2.INTER_AREA).reshape((height, width, 3))
+            levels.append(level.ravel())
+        return np.concatenate(levels).astype(np.float32)
+
+    # Mip level whose texels cover (on average) the given solid angle (a number or an array), e.g. 2 pi / n for n
+    # uniform hemisphere samples, or 1 / (n p(w)) for a sample of density p(w)
+    def level_for_solid_angle(self, solid_angle):
+        texel_solid_angle = 4.0 * PI / (self.width * self.height)
+        return np.maximum(0.0, 0.5 * np.log2(np.maximum(solid_angle, 1e-300) / texel_solid_angle))
+
+    # Irradiance E(n) = int L(w) max(0, n . w) dw of (N, 3) normals, an (N, 3) float32 array: a bilinear lookup of
+    # the cosine-prefiltered irradiance map (see get_irradiance_map)
+    def irradiance(self, normals):
+        u, v = self.euclidean_to_latlong_batch(normals)
+        irradiance_map = self.get_irradiance_map()
+        return self.fetch_bilinear(irradiance_map.reshape(-1, 3), ENV_MAP_IRRADIANCE_WIDTH, ENV_MAP_IRRADIANCE_HEIGHT,
+                                   u, v)
+
+    # Cosine-prefiltered irradiance map: E(n) for the normals n at the texel centers of an
+    # ENV_MAP_IRRADIANCE_HEIGHT x ENV_MAP_IRRADIANCE_WIDTH lat-long grid, computed once and stored in the cache
+    def get_irradiance_map(self):
+        if self.irradiance_map is None:
+            key = (self.content_hash + '_irradiance_' + str(ENV_MAP_IRRADIANCE_WIDTH) + 'x' +
+                   str(ENV_MAP_IRRADIANCE_HEIGHT) + '_' + str(ENV_MAP_IRRADIANCE_SOURCE_WIDTH))
+            self.irradiance_map = cached_array(key, self.compute_irradiance_map)
+        return self.irradiance_map
+
+    def compute_irradiance_map(self):
+        # The cosine lobe is smooth, so the integral is a sum over the texels of the first mip level at most
+        # ENV_MAP_IRRADIANCE_SOURCE_WIDTH wide, weighted by their solid angle
+        source = next(level for level in self.get_mip_levels() if level.shape[1] <= ENV_MAP_IRRADIANCE_SOURCE_WIDTH)
+        # (accumulated over batches of ENV_MAP_IRRADIANCE_BATCH source texels)
+        dirs, d_omega = self.texel_directions(source.shape[0], source.shape[1])
+        texels = source.reshape(-1, 3)
+        normals, _ = self.texel_directions(ENV_MAP_IRRADIANCE_HEIGHT, ENV_MAP_IRRADIANCE_WIDTH)
+        irradiance = np.zeros((len(normals), 3))
+        for start in range(0, len(dirs), ENV_MAP_IRRADIANCE_BATCH):
+            batch = slice(start, start + ENV_MAP_IRRADIANCE_BATCH)
+            radiance = texels[batch].astype(np.float64) * d_omega[batch, np.newaxis]
+            irradiance += np.maximum(normals @ dirs[batch].T, 0.0) @ radiance
+        return irradiance.reshape((ENV_MAP_IRRADIANCE_HEIGHT, ENV_MAP_IRRADIANCE_WIDTH, 3)).astype(np.float32)
+
+    # Projection of the map onto the real SH basis of bands 0..order (see sh_basis): (order + 1)^2 x 3 array of
+    # L_lm = int L(w) Y_lm(w) dw, a sum over all the texels weighted by their solid angle, computed once and stored
+    # in the on-disk cache
+    def sh_coefficients(self, order=2):
+        return cached_array(self.content_hash + '_sh_' + str(order), lambda: self.compute_sh_coefficients(order))
+
+    def compute_sh_coefficients(self, order):
+        dirs, d_omega = self.texel_directions(self.height, self.width)
+        coefficients = np.zeros(((order + 1) ** 2, 3))
+        for start in range(0, len(dirs), SH_PROJECTION_BATCH):
+            batch = slice(start, start + SH_PROJECTION_BATCH)
+            radiance = self.texels[batch].astype(np.float64) * d_omega[batch, np.newaxis]
+            coefficients += sh_basis(dirs[batch], order).T @ radiance
+        return coefficients
+
+    # Irradiance E(n) = int L(w) max(0, n . w) dw of (N, 3) normals from the SH projection of the map:
+    # E(n) = sum_lm A_l L_lm Y_lm(n), an (N, 3) array (order 2 is within a few percent for any map)
+    def sh_irradiance(self, normals, order=2):
+        return sh_basis(normals, order) @ (sh_cosine_lobe(order)[:, np.newaxis] * self.sh_coefficients(order))
+
+    # Directions of the texel centers of a (height, width) lat-long grid, as an (height * width, 3) array, and the
+    # solid angle of each texel
+    def texel_directions(self, height, width):
+        u_grid, v_grid = np.meshgrid((np.arange(width) + 0.5) / width, (np.arange(height) + 0.5) / height)
+        dirs = self.latlong_to_euclidean_batch(u_grid.ravel(), v_grid.ravel())
+        d_omega = np.sin(PI * v_grid.ravel()) * (PI / height) * (2.0 * PI / width)
+        return dirs, d_omega
+
+    # Importance sampling of the environment map
+    # Builds a 2D piecewise-constant distribution proportional to luminance * sin(theta) over the texel cells
+    # used by getValue: (height - 1) rows and (width - 1) columns of size 1/(height - 1) x 1/(width - 1) in (u, v)
+    def build_sampling_distribution(self):
+        self.n_rows = self.height - 1
+        self.n_cols = self.width - 1
+        cells = self.env_map_hdr[:self.n_rows, :self.n_cols, :]
+        theta = PI * (np.arange(self.n_rows) + 0.5) / self.n_rows  # polar angle at the center of each row
+        weights = luminance_array(cells) * np.sin(theta)[:, np.newaxis]
+        total = weights.sum()
+        if total <= 0.0:  # black map: sample uniformly in (u, v)
+            weights = np.ones_like(weights)
+            total = weights.sum()
+        row_sums = weights.sum(axis=1)
+        # Marginal CDF over the rows (v) and conditional CDFs over the columns (u) of each row
+        self.marginal_cdf = np.concatenate(([0.0], np.cumsum(row_sums))) / total
+        empty_rows = row_sums <= 0.0
+        row_weights = np.where(empty_rows[:, np.newaxis], 1.0, weights)
+        self.conditional_cdf = np.concatenate((np.zeros((self.n_rows, 1)), np.cumsum(row_weights, axis=1)), axis=1)
+        self.conditional_cdf /= self.conditional_cdf[:, -1:]
+        # All conditional CDFs in one increasing array (row i shifted by 2 * i) to search them in a single call
+        self.conditional_cdf_flat = (self.conditional_cdf + 2.0 * np.arange(self.n_rows)[:, np.newaxis]).ravel()
+        # Density of each cell with respect to (u, v)
+        self.cell_pdf = weights / total * (self.n_rows * self.n_cols)
+
+    # Returns a direction sampled proportionally to the environment map and its pdf (with respect to solid angle)
+    def sample(self, u1, u2):
+        dirs, pdfs = self.sample_batch(np.array([[u1, u2]]))
+        d = dirs[0].tolist()
+        return Vector3D(d[0], d[1], d[2]), float(pdfs[0])
+
+    # Pdf (with respect to solid angle) of sampling direction d with sample
+    def pdf(self, d):
+        return float(self.pdf_batch(np.array([[d.x, d.y, d.z]]))[0])
+
+    # Batched version of sample: u is an (N, 2) array of random numbers, returns (N, 3) directions and (N,) pdfs
+    def sample_batch(self, u):
+        # Row (v) from the marginal distribution, column (u) from the conditional distribution of that row
+        rows = np.clip(np.searchsorted(self.marginal_cdf, u[:, 1], side='right') - 1, 0, self.n_rows - 1)
+        cdf_0 = self.marginal_cdf[rows]
+        dv = (u[:, 1] - cdf_0) / np.maximum(self.marginal_cdf[rows + 1] - cdf_0, 1e-300)
+        cols = np.searchsorted(self.conditional_cdf_flat, u[:, 0] + 2.0 * rows, side='right') - 1
+        cols = np.clip(cols - rows * (self.n_cols + 1), 0, self.n_cols - 1)
+        cdf_0 = self.conditional_cdf[rows, cols]
+        du = (u[:, 0] - cdf_0) / np.maximum(self.conditional_cdf[rows, cols + 1] - cdf_0, 1e-300)
+        v = (rows + np.clip(dv, 0.0, 1.0)) / self.n_rows
+        u_ll = (cols + np.clip(du, 0.0, 1.0)) / self.n_cols
+        dirs = self.latlong_to_euclidean_batch(u_ll, v)
+        return dirs, self.uv_pdf_to_solid_angle(self.cell_pdf[rows, cols], v)
+
+    # Batched version of pdf: (N, 3) directions to (N,) pdfs
+    def pdf_batch(self, dirs):
+        u, v = self.euclidean_to_latlong_batch(dirs)
+        cols = np.clip(np.floor(u * self.n_cols).astype(int), 0, self.n_cols - 1)
+        rows = np.clip(np.floor(v * self.n_rows).astype(int), 0, self.n_rows - 1)
+        return self.uv_pdf_to_solid_angle(self.cell_pdf[rows, cols], v)
+
+    # Integral over the sphere of L(omega) * max(0, normal . omega)^exponent, returned as a (3,) RGB array
+    # Computed in one NumPy pass over all texels and stored in the on-disk cache (keyed by the file content)
+    def cosine_integral(self, normal=Vector3D(0.0, 1.0, 0.0), exponent=1):
+        n = Normalize(normal)
+        key = f'{self.content_hash}_cosine_integral_{n.x:.6f}_{n.y:.6f}_{n.z:.6f}_{exponent}'
+        return cached_array(key, lambda: self.compute_cosine_integral(vector_to_array(n), exponent))
+
+    def compute_cosine_integral(self, normal, exponent):
+        # Lat-long coordinates of every texel and its solid angle d_omega = sin(theta) * d_theta * d_phi
+        u = np.arange(self.width) / (self.width - 1)
+        v = np.arange(self.height) / (self.height - 1)
+        u_grid, v_grid = np.meshgrid(u, v)
+        dirs = self.latlong_to_euclidean_batch(u_grid.ravel(), v_grid.ravel())
+        d_omega = np.sin(PI * v_grid.ravel()) * (PI / self.height) * (2 * PI / self.width)
+        cos_theta = dirs @ normal
+        weights = np.where(cos_theta > 0.0, np.maximum(cos_theta, 0.0) ** exponent, 0.0) * d_omega
+        return weights @ self.env_map_hdr.reshape(-1, 3).astype(np.float64)
+
+    # d_omega = sin(theta) d_theta d_phi = 2 * pi^2 * sin(theta) du dv
+    @staticmethod
+    def uv_pdf_to_solid_angle(pdf_uv, v):
+        sin_theta = np.sin(PI * v)
+        return np.where(sin_theta > 0.0, pdf_uv / (2.0 * PI * PI * np.maximum(sin_theta, 1e-300)), 0.0)
+
 
 # -------------------------------------------------Functions over the hemisphere
 class Function(ABC):
@@ -260,6 +1247,10 @@ class Function(ABC):
     def eval(self, omega_i):
         pass
 
+    # Batched version of eval: (N, 3) directions to (N,) values
+    def eval_batch(self, dirs):
+        return np.array([self.eval(Vector3D(d[0], d[1], d[2])) for d in dirs.tolist()], dtype=np.float64)
+
     @abstractmethod
     def get_integral(self):
         pass
@@ -274,6 +1265,9 @@ class Constant(Function):
     def eval(self, omega_i):
         return self.const_value
 
+    def eval_batch(self, dirs):
+        return np.full(len(dirs), self.const_value, dtype=np.float64)
+
     def get_integral(self):
         return 2 * pi * self.const_value
 
@@ -288,6 +1282,9 @@ class CosineLobe(Function):
         normal = Vector3D(0, 1, 0)
         return Dot(normal, omega_i) ** self.exp
 
+    def eval_batch(self, dirs):
+        return dirs[:, 1] ** self.exp
+
     def get_integral(self):
         return 2 * pi / (self.exp + 1)
 
@@ -302,36 +1299,35 @@ class ArchEnvMap(Function):
         # Convert RBG to scalar value
         return 0.2126 * color.r + 0.7152 * color.g + 0.0722 * color.b 
 
+    def eval_batch(self, dirs):
+        return luminance_array(self.env_map.lookup(dirs).astype(np.float64))
+
+    # Integral of L_i * cos over the hemisphere around (0, 1, 0) (the brdf is assumed to be 1)
+    def get_integral(self):
+        return float(luminance_array(self.env_map.cosine_integral(Vector3D(0.0, 1.0, 0.0), 1)))
+
+
+# Luminance of the spherical harmonics approximation (bands 0..order) of an environment map, e.g. a control variate
+# for ArchEnvMap: its integral with the cosine lobe is known in closed form (EnvironmentMap.sh_irradiance)
+class SHEnvMap(Function):
+    def __init__(self, env_map, order=2):
+        self.env_map = env_map
+        self.order = order
+        self.coefficients = luminance_array(env_map.sh_coefficients(order))  # ((order + 1)^2,) luminance coefficients
+        integral = self.get_integral()
+        super().__init__(integral)
+
+    def eval(self, omega_i):
+        return float(self.eval_batch(vector_to_array(omega_i)[np.newaxis, :])[0])
+
+    def eval_batch(self, dirs):
+        return sh_basis(dirs, self.order) @ self.coefficients
+
+    # Integral of the approximation * cos over the hemisphere around (0, 1, 0), like ArchEnvMap.get_integral
     def get_integral(self):
-        integral = 0.0
-        
-        for ty in range(self.env_map.height):
-            for tx in range(self.env_map.width):
-                # Convert pixel to lat-long coordinates
-                u = tx / (self.env_map.width - 1)
-                v = ty / (self.env_map.height - 1)
-                
-                # Convert to spherical coordinates
-                phi = 2 * PI * u
-                theta = PI * v
-                
-                # Convert to direction vector
-                omega = Vector3D(sin(theta) * sin(phi), cos(theta), -sin(theta) * cos(phi))
-                
-                # Check if direction is hemisphere (0, 1, 0)
-                if omega.y > 0:
-                    res = self.env_map.env_map_hdr[ty, tx, :]
-                    L = 0.2126 * res[0] + 0.7152 * res[1] + 0.0722 * res[2]
-                    
-                    # Compute solid angle of pixel
-                    d_phi = 2 * PI / self.env_map.width
-                    d_theta = PI / self.env_map.height
-                    d_omega = sin(theta) * d_theta * d_phi
-                    
-                    # l_o = l_i * brdf * cos(theta) * d_omega (assumed brdf = 1)
-                    integral += L * cos(theta) * d_omega
-        
-        return integral
+        return float(luminance_array(self.env_map.sh_irradiance(np.array([[0.0, 1.0, 0.0]]), self.order)[0]))
+
+
 # -------------------------------------------------Base class for pdfs oer the hemisphere 2*pi
 class PDF(ABC):
 
@@ -343,6 +1339,18 @@ class PDF(ABC):
     def generate_dir(self, u1, u2):
         pass
 
+    # Batched version of get_val: (N, 3) directions to (N,) pdf values
+    def get_vals(self, dirs):
+        return np.array([self.get_val(Vector3D(d[0], d[1], d[2])) for d in dirs.tolist()], dtype=np.float64)
+
+    # Batched version of generate_dir: u is an (N, 2) array of random numbers (u1, u2), returns (N, 3) directions
+    def generate_dirs(self, u):
+        dirs = np.zeros((len(u), 3))
+        for i, (u1, u2) in enumerate(u.tolist()):
+            omega_i = self.generate_dir(u1, u2)
+            dirs[i] = (omega_i.x, omega_i.y, omega_i.z)
+        return dirs
+
 
 # Uniform PDF over the hemisphere: p(omega) = 1/(2*pi)
 class UniformPDF(PDF):
@@ -360,6 +1368,15 @@ class UniformPDF(PDF):
         z = cos(phi) * aux_sqrt
         return Vector3D(x, y, z)
 
+    def get_vals(self, dirs):
+        return np.full(len(dirs), 1 / (2 * pi))
+
+    def generate_dirs(self, u):
+        y = u[:, 1]
+        phi = TWO_PI * u[:, 0]
+        aux_sqrt = np.sqrt(1 - y ** 2)
+        return np.stack((np.sin(phi) * aux_sqrt, y, np.cos(phi) * aux_sqrt), axis=1)
+
 
 # PDF: p(omega) = (n+1)/(2*pi) * cos(theta)**n
 class CosinePDF(PDF):
@@ -381,3 +1398,12 @@ class CosinePDF(PDF):
         x = sin(phi) * aux_sqrt
         z = cos(phi) * aux_sqrt
         return Vector3D(x, y, z)
+
+    def get_vals(self, dirs):
+        return (self.exp + 1) / (2 * pi) * dirs[:, 1] ** self.exp
+
+    def generate_dirs(self, u):
+        y = u[:, 1] ** (1.0 / (self.exp + 1.0))
+        phi = TWO_PI * u[:, 0]
+        aux_sqrt = np.sqrt(1 - u[:, 1] ** (2.0 / (self.exp + 1.0)))
+        return np.stack((np.sin(phi) * aux_sqrt, y, np.cos(phi) * aux_sqrt), axis=1)
@@ -4,6 +4,9 @@ from abc import ABC, abstractmethod  # Abstract Base Class
 from math import tan
 import numpy as np
 
+PRIMARY_BUFFER_BATCH = 2 ** 16  # camera rays traced at once when filling the per-pixel hit buffers of a Scene
+SECONDARY_RAYS = ('none', 'lights', 'hemisphere', 'paths')  # what the rays of an integrator can reach (see Scene)
+
 
 # -------------------------------------------------BRDF classes
 class Scene:
@@ -14,50 +17,433 @@ class Scene:
         self.object_list = []  # object list
         self.pointLights = []  # list of point light sources (for Phong Illumination)
         self.i_a = None
+        self.primitive_packs = None  # per-type packed primitive arrays for batched queries (see finalize)
+        self.bvh = None  # bounding volume hierarchy over the bounded primitives (see finalize)
+        self.unbounded_indices = []  # object_list indices of the primitives that can not be bounded (planes)
+        self.linear_indices = []  # object_list indices of the primitives tested one by one (not in the BVH)
+        self.light_table = None  # AliasTable that chooses a light proportionally to its power (see build_light_index)
+        self.light_primitive = None  # per light: object_list index of the emissive primitive, or -1
+        self.light_point = None  # per light: pointLights index of the point light, or -1
+        self.light_area = None  # per light: area of the emissive primitive (0 for point lights)
+        self.light_slot = None  # per primitive: its light index, or -1 if it is not a light that can be sampled
+        self.light_packs = None  # per primitive type: (class, light indices, packed arrays of those primitives)
+        self.light_pack_index = None  # per light: index of the primitive in its light pack (-1 for point lights)
+        self.point_light_positions = None  # (L, 3) array, positions of the point lights
+        self.point_light_intensities = None  # (L, 3) array, intensities of the point lights
+        self.finalized = False  # whether the acceleration data is up to date with object_list
+        self.finalized_versions = []  # Primitive.version of every primitive when the scene was finalized
+        # Change tracking for the incremental renders (see find_dirty_pixels and Integrator.render_incremental)
+        self.dirty_primitives = set()  # object_list indices of the primitives added or changed since the last record
+        self.dirty_lights = set()  # pointLights indices of the point lights added or changed since the last record
+        self.full_update = True  # a change that affects every pixel (camera, environment map, ambient light)
+        self.recorded_versions = []  # Primitive.version of every primitive when the last render was recorded
+        self.recorded_geometry = []  # per primitive: (class, packed arrays, bounds) when the last render was recorded
+        self.recorded_light_positions = None  # (L, 3) array, positions of the point lights at the last record
+        self.recorded_light_selection = None  # emitter index at the last record (see get_light_selection)
+        self.render_record = None  # key of the last recorded render (see record_render)
+        # Per-pixel hit buffers of the last recorded render ((height, width) arrays, see compute_hit_buffers)
+        self.primitive_buffer = None  # object_list index of the primary hit (-1 for the pixels that miss)
+        self.distance_buffer = None  # distance to the primary hit (inf for the pixels that miss)
+
+    # Pickling (the scene sent to the worker processes of a parallel render) leaves out the per-pixel buffers:
+    # the workers render into a SharedFramebuffer and never read the hit buffers of the incremental renders
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['rendered_image'] = None
+        state['primitive_buffer'] = None
+        state['distance_buffer'] = None
+        return state
 
     def set_ambient(self, i_a):
         self.i_a = i_a
+        self.full_update = True
 
     # set camera
     def set_camera(self, camera):
         self.camera = camera
         self.rendered_image = np.zeros((camera.height, camera.width, 3))
+        self.full_update = True
 
-    # set environment map
-    def set_environment_map(self, env_map_path):
-        self.env_map = EnvironmentMap(env_map_path)
+    # set environment map (lookup_mode: texel filtering, see EnvironmentMap)
+    def set_environment_map(self, env_map_path, lookup_mode='nearest'):
+        self.env_map = EnvironmentMap(env_map_path, lookup_mode)
+        self.full_update = True
 
     # add objects
     def add_object(self, new_object):
         self.object_list.append(new_object)
+        self.dirty_primitives.add(len(self.object_list) - 1)
+        self.finalized = False  # acceleration data is rebuilt on the next query
+
+    # Record changes made directly to the attributes of a primitive (e.g. its geometry) or of a point light, or to
+    # anything else (mark_all_dirty), for the next incremental render. set_BRDF and set_emission are tracked
+    # without this (see Primitive.version)
+    def mark_primitive_dirty(self, primitive):
+        self.dirty_primitives.add(self.object_list.index(primitive))
+        self.finalized = False
+
+    def mark_light_dirty(self, point_light):
+        self.dirty_lights.add(self.pointLights.index(point_light))
+        self.finalized = False
+
+    def mark_all_dirty(self):
+        self.full_update = True
+        self.finalized = False
+
+    # Build the acceleration data used by the ray queries:
+    # - primitives of the same type are packed into contiguous parameter arrays for the batched queries,
+    #   stored as a list of (primitive class, object_list indices, packed arrays)
+    # - bounded primitives go into a BVH, unbounded ones (InfinitePlane) are kept in a separate list
+    def finalize(self):
+        primitive_types = []
+        for obj in self.object_list:
+            if type(obj) not in primitive_types:
+                primitive_types.append(type(obj))
+        self.primitive_packs = []
+        for primitive_type in primitive_types:
+            indices = [i for i, obj in enumerate(self.object_list) if type(obj) is primitive_type]
+            packed = primitive_type.pack([self.object_list[i] for i in indices])
+            self.primitive_packs.append((primitive_type, np.array(indices), packed))
+
+        bounded_indices = []
+        bounds = []
+        self.unbounded_indices = []
+        for i, obj in enumerate(self.object_list):
+            obj_bounds = obj.get_bounds()
+            if obj_bounds is None:
+                self.unbounded_indices.append(i)
+            else:
+                bounded_indices.append(i)
+                bounds.append(obj_bounds)
+        if len(bounded_indices) >= BVH_MIN_PRIMITIVES:
+            self.bvh = BVH(bounded_indices, bounds)
+            self.linear_indices = self.unbounded_indices
+        else:
+            # For a handful of primitives the box tests cost more than they save
+            self.bvh = None
+            self.linear_indices = self.unbounded_indices + bounded_indices
+        self.build_light_index()
+        self.finalized_versions = [obj.version for obj in self.object_list]
+        self.finalized = True
+
+    # Finalize the scene if it is not up to date: objects or lights were added or marked dirty, or a primitive
+    # changed through its setters since it was finalized (e.g. set_emission, which changes the emitter index)
+    # Called by the render loops before the first query
+    def update(self):
+        if self.finalized and [obj.version for obj in self.object_list] != self.finalized_versions:
+            self.finalized = False
+        if not self.finalized:
+            self.finalize()
+
+    # Emitter index: the lights of the scene are the emissive primitives with an area (sampled uniformly by area)
+    # and the point lights. Each one is chosen by sample_lights proportionally to its power:
+    # pi * area * luminance(emission) for a (diffuse) emissive primitive, 4 * pi * luminance(intensity) for a
+    # point light
+    def build_light_index(self):
+        light_primitive = []
+        light_point = []
+        light_area = []
+        powers = []
+        for i, obj in enumerate(self.object_list):
+            area = obj.get_area()
+            if area is None:
+                continue
+            power = PI * area * float(luminance_array(color_to_array(obj.emission)))
+            if power > 0.0:
+                light_primitive.append(i)
+                light_point.append(-1)
+                light_area.append(area)
+                powers.append(power)
+        for j, light in enumerate(self.pointLights):
+            power = 4.0 * PI * float(luminance_array(color_to_array(light.intensity)))
+            if power > 0.0:
+                light_primitive.append(-1)
+                light_point.append(j)
+                light_area.append(0.0)
+                powers.append(power)
+        self.light_primitive = np.array(light_primitive, dtype=np.int64)
+        self.light_point = np.array(light_point, dtype=np.int64)
+        self.light_area = np.array(light_area, dtype=np.float64)
+        self.light_table = AliasTable(powers) if powers else None
+        self.light_slot = np.full(len(self.object_list), -1, dtype=np.int64)
+        self.light_slot[self.light_primitive[self.light_primitive >= 0]] = np.flatnonzero(self.light_primitive >= 0)
+
+        self.light_packs = []
+        self.light_pack_index = np.full(len(light_primitive), -1, dtype=np.int64)
+        for primitive_type in dict.fromkeys(type(self.object_list[i]) for i in light_primitive if i >= 0):
+            lights = np.array([k for k, i in enumerate(light_primitive)
+                               if i >= 0 and type(self.object_list[i]) is primitive_type], dtype=np.int64)
+            packed = primitive_type.pack([self.object_list[i] for i in self.light_primitive[lights]])
+            self.light_packs.append((primitive_type, lights, packed))
+            self.light_pack_index[lights] = np.arange(len(lights))
+        self.point_light_positions = np.array([vector_to_array(l.pos) for l in self.pointLights]).reshape(-1, 3)
+        self.point_light_intensities = np.array([color_to_array(l.intensity) for l in self.pointLights]).reshape(-1, 3)
+
+    # Number of lights in the emitter index
+    def n_lights(self):
+        if not self.finalized:
+            self.finalize()
+        return len(self.light_primitive)
+
+    # Light selection from uniform random numbers u (np array of any shape): returns the light indices (same shape
+    # as u) and the probabilities of choosing them. Must not be called on a scene without lights (n_lights() == 0)
+    def sample_lights(self, u):
+        if not self.finalized:
+            self.finalize()
+        lights = self.light_table.sample(u)
+        return lights, self.light_table.pdf[lights]
+
+    # Per-sample version of sample_lights: returns a tuple (light index, probability) from one uniform random number
+    def sample_light(self, u):
+        lights, probabilities = self.sample_lights(u)
+        return int(lights), float(probabilities)
+
+    # Probability that sample_lights chooses each of the given lights
+    def light_probability(self, lights):
+        if not self.finalized:
+            self.finalize()
+        return self.light_table.pdf[lights]
+
+    # Uniform points (by area) on the emissive primitives of the given (K,) lights from a (K, 2) array of uniform
+    # random numbers: returns the (K, 3) arrays of points and normals (one batched call per primitive type)
+    def sample_light_points(self, lights, u):
+        points = np.zeros((len(lights), 3))
+        normals = np.zeros((len(lights), 3))
+        for primitive_type, type_lights, packed in self.light_packs:
+            chosen = np.flatnonzero(np.isin(lights, type_lights))
+            if len(chosen) > 0:
+                points[chosen], normals[chosen] = primitive_type.sample_points_batch(
+                    packed, self.light_pack_index[lights[chosen]], u[chosen])
+        return points, normals
 
     # add point light sources
     def add_point_light_sources(self, point_light):
         self.pointLights.append(point_light)
+        self.dirty_lights.add(len(self.pointLights) - 1)
+        self.finalized = False  # the emitter index is rebuilt on the next query
 
-    def any_hit(self, ray):
+    # Occlusion query: whether the ray hits any primitive (no hit data is computed)
+    # If a light is given, the primitive that blocked its previous shadow ray is tested first
+    def any_hit(self, ray, light=None):
         # ASSIGNMENT 1.2: PUT YOUR CODE HERE
-        return any(object.intersect(ray).has_hit for object in self.object_list)
+        if light is not None and light.last_occluder >= 0:
+            if self.object_list[light.last_occluder].occluded(ray):
+                return True
+        occluder = self.find_occluder(ray)
+        if light is not None and occluder >= 0:
+            light.last_occluder = occluder
+        return occluder >= 0
+
+    # Returns the object_list index of the first primitive found that blocks the ray, or -1
+    def find_occluder(self, ray):
+        if not self.finalized:
+            self.finalize()
+        for i in self.linear_indices:
+            if self.object_list[i].occluded(ray):
+                return i
+        if self.bvh is not None:
+            return self.bvh.find_occluder(ray, self.object_list)
+        return -1
 
     def closest_hit(self, ray):
         # find closest hit object, its distance, hit_point and normal
-        # scan through primitives in scene, find closest
+        # scan through the primitives not in the BVH, then traverse the BVH with the closest distance found so far
+        if not self.finalized:
+            self.finalize()
         hit_data = HitData()
-        for i in range(len(self.object_list)):
+        for i in self.linear_indices:
             this_hit = self.object_list[i].intersect(ray)
             if this_hit.has_hit:  # Hit
                 if this_hit.hit_distance < hit_data.hit_distance:  # Distance
                     hit_data = this_hit
                     hit_data.primitive_index = i
+        if self.bvh is not None:
+            hit_data = self.bvh.closest_hit(ray, self.object_list, hit_data)
+        return hit_data
+
+    # Batched version of any_hit: returns an (N,) boolean array
+    def any_hit_batch(self, rays):
+        if not self.finalized:
+            self.finalize()
+        occluded = np.zeros(len(rays), dtype=bool)
+        for primitive_type, indices, packed in self.primitive_packs:
+            t, hit, index, normal = primitive_type.intersect_batch(packed, rays)
+            occluded |= hit
+        return occluded
+
+    # Batched version of closest_hit: returns a BatchHitData
+    def closest_hit_batch(self, rays):
+        if not self.finalized:
+            self.finalize()
+        hit_data = BatchHitData(len(rays))
+        for primitive_type, indices, packed in self.primitive_packs:
+            t, hit, index, normal = primitive_type.intersect_batch(packed, rays)
+            closer = hit & (t < hit_data.hit_distance)
+            hit_data.has_hit |= closer
+            hit_data.hit_distance[closer] = t[closer]
+            hit_data.normal[closer] = normal[closer]
+            hit_data.primitive_index[closer] = indices[index[closer]]
+        hit_data.hit_point[hit_data.has_hit] = rays.get_hitpoints(hit_data.hit_distance)[hit_data.has_hit]
         return hit_data
 
+    # Per-primitive shading data for the batched integrators, as (M, 3) arrays indexed like object_list:
+    # emissions and diffuse colors (kd, black for primitives without a BRDF)
+    def get_material_arrays(self):
+        emission = np.array([color_to_array(obj.emission) for obj in self.object_list]).reshape(-1, 3)
+        kd = np.array([color_to_array(obj.get_BRDF().kd) if obj.get_BRDF() is not None else np.zeros(3)
+                       for obj in self.object_list]).reshape(-1, 3)
+        return emission, kd
+
+    # Primitives changed since the last recorded render: the dirty ones and those whose version changed
+    # (set_BRDF, set_emission)
+    def changed_primitives(self):
+        changed = set(self.dirty_primitives)
+        for i, obj in enumerate(self.object_list):
+            if i >= len(self.recorded_versions) or obj.version != self.recorded_versions[i]:
+                changed.add(i)
+        return changed
+
+    # Per-pixel hit buffers of the primary rays: (height, width) arrays of the object_list index of the closest hit
+    # (-1 if none), its distance (inf if none), and (height, width, 3) arrays of the hit points and of the normals
+    # (turned towards the camera)
+    def compute_hit_buffers(self):
+        cam = self.camera
+        n_pixels = cam.width * cam.height
+        primitives = np.full(n_pixels, -1, dtype=np.int64)
+        distances = np.full(n_pixels, np.inf)
+        points = np.zeros((n_pixels, 3))
+        normals = np.zeros((n_pixels, 3))
+        for start in range(0, n_pixels, PRIMARY_BUFFER_BATCH):
+            rays = cam.generate_pixel_rays(np.arange(start, min(start + PRIMARY_BUFFER_BATCH, n_pixels)))
+            hit_data = self.closest_hit_batch(rays)
+            chunk = slice(start, start + len(rays))
+            primitives[chunk] = np.where(hit_data.has_hit, hit_data.primitive_index, -1)
+            distances[chunk] = np.where(hit_data.has_hit, hit_data.hit_distance, np.inf)
+            points[chunk] = hit_data.hit_point
+            facing = np.einsum('ij,ij->i', hit_data.normal, rays.d) > 0.0
+            normals[chunk] = np.where(facing[:, np.newaxis], -hit_data.normal, hit_data.normal)
+        shape = (cam.height, cam.width)
+        return primitives.reshape(shape), distances.reshape(shape), points.reshape(shape + (3,)), \
+            normals.reshape(shape + (3,))
+
+    # Geometry of a primitive as tested by find_dirty_pixels: (class, packed arrays, bounds)
+    @staticmethod
+    def get_geometry(obj):
+        return type(obj), type(obj).pack([obj]), obj.get_bounds()
+
+    # Light selection of the emitter index: the light of each entry (primitive and point light indices) and the
+    # probability of choosing it (see build_light_index)
+    def get_light_selection(self):
+        self.update()
+        pdf = self.light_table.pdf if self.light_table is not None else np.zeros(0)
+        return self.light_primitive.copy(), self.light_point.copy(), pdf.copy()
+
+    # Whether the light selection changed since the last recorded render (e.g. the power of a light changed)
+    def light_selection_changed(self):
+        if self.recorded_light_selection is None:
+            return True
+        return not all(np.array_equal(a, b) for a, b in zip(self.get_light_selection(),
+                                                            self.recorded_light_selection))
+
+    # Record the render just finished (identified by key): its hit buffers (hit_buffers, from compute_hit_buffers
+    # or find_dirty_pixels, are computed if not given), the versions and geometry of the primitives, the positions
+    # of the point lights and the light selection, and clear the change tracking
+    def record_render(self, key, hit_buffers=None):
+        if hit_buffers is None:
+            hit_buffers = self.compute_hit_buffers()
+        self.primitive_buffer, self.distance_buffer = hit_buffers[0], hit_buffers[1]
+        self.recorded_versions = [obj.version for obj in self.object_list]
+        self.recorded_geometry = [self.get_geometry(obj) for obj in self.object_list]
+        self.recorded_light_selection = self.get_light_selection()  # (finalizes the scene)
+        self.recorded_light_positions = self.point_light_positions
+        self.dirty_primitives = set()
+        self.dirty_lights = set()
+        self.full_update = False
+        self.render_record = key
+
+    # (height, width) boolean mask of the pixels that the changes since the last recorded render can affect,
+    # for an integrator whose secondary rays (one of SECONDARY_RAYS) reach:
+    # - 'none': nothing (only the primary hit is shaded)
+    # - 'lights': the point lights (shadow rays)
+    # - 'hemisphere': anything above the tangent plane of the hit point (one bounce)
+    # - 'paths': anything (several bounces)
+    # A pixel is dirty if its primary hit changed (other primitive or distance) or is a changed primitive, or if its
+    # secondary rays can reach a changed primitive or point light: shadow segments that intersect a changed
+    # primitive, or changed primitives (bounding boxes) and lights above the tangent plane. Both the geometry of a
+    # changed primitive at the last record and its current one are tested (the pixels it no longer shadows change
+    # too), as are both positions of a changed light. Occlusion is ignored, so the mask is conservative
+    # light_selection: the integrator chooses lights with the emitter index (sample_lights), so every pixel is
+    # dirty when the selection probabilities changed (a change of the power of any light reweights all the pixels)
+    # Returns the mask and the hit buffers of the primary rays (to be passed on to record_render)
+    def find_dirty_pixels(self, secondary_rays='paths', light_selection=False):
+        if secondary_rays not in SECONDARY_RAYS:
+            raise ValueError('Unknown secondary rays: ' + str(secondary_rays))
+        changed = self.changed_primitives()
+        if changed or self.dirty_lights:
+            self.finalized = False  # emissions and geometry may have changed
+        hit_buffers = self.compute_hit_buffers()
+        primitives, distances, points, normals = hit_buffers
+        if self.full_update or self.primitive_buffer is None or primitives.shape != self.primitive_buffer.shape:
+            return np.ones(primitives.shape, dtype=bool), hit_buffers
+        if light_selection and self.light_selection_changed():
+            return np.ones(primitives.shape, dtype=bool), hit_buffers
+        dirty = (primitives != self.primitive_buffer) | (np.isfinite(distances) != np.isfinite(self.distance_buffer))
+        both_hit = np.isfinite(distances) & np.isfinite(self.distance_buffer)
+        dirty[both_hit] |= np.abs(distances[both_hit] - self.distance_buffer[both_hit]) > \
+            EPSILON * np.maximum(distances[both_hit], 1.0)
+        dirty |= np.isin(primitives, list(changed)) | np.isin(self.primitive_buffer, list(changed))
+        hit = primitives >= 0
+        if secondary_rays == 'none' or not (changed or self.dirty_lights):
+            return dirty, hit_buffers
+        if secondary_rays == 'paths':
+            return dirty | hit, hit_buffers
+        # Old and current geometry of the changed primitives
+        geometry = []
+        for i in changed:
+            geometry.append(self.get_geometry(self.object_list[i]))
+            if i < len(self.recorded_geometry):
+                geometry.append(self.recorded_geometry[i])
+        p = points[hit]
+        n = normals[hit]
+        reached = np.zeros(len(p), dtype=bool)
+        if secondary_rays == 'lights':
+            if self.dirty_lights:
+                reached[:] = True  # a new or changed light can light any hit point
+            else:
+                for light in self.pointLights:
+                    w = vector_to_array(light.pos) - p
+                    distance = np.sqrt(np.einsum('ij,ij->i', w, w))
+                    segments = RayPacket(p, w / np.maximum(distance, EPSILON)[:, np.newaxis], distance)
+                    for primitive_type, packed, bounds in geometry:
+                        t, blocked, index, normal = primitive_type.intersect_batch(packed, segments)
+                        reached |= blocked
+        else:
+            for primitive_type, packed, bounds in geometry:
+                if bounds is None:
+                    reached[:] = True
+                    break
+                corners = np.array([[x, y, z] for x in (bounds[0][0], bounds[1][0])
+                                    for y in (bounds[0][1], bounds[1][1]) for z in (bounds[0][2], bounds[1][2])])
+                reached |= np.any(n @ corners.T - np.einsum('ij,ij->i', n, p)[:, np.newaxis] > 0.0, axis=1)
+            positions = self.point_light_positions  # up to date: compute_hit_buffers finalized the scene
+            for j in self.dirty_lights:
+                light_positions = [positions[j]]
+                if self.recorded_light_positions is not None and j < len(self.recorded_light_positions):
+                    light_positions.append(self.recorded_light_positions[j])
+                for position in light_positions:
+                    reached |= np.einsum('ij,ij->i', position - p, n) > 0.0
+        dirty[hit] |= reached
+        return dirty, hit_buffers
+
     # save pixel array to file
+    # (reads rendered_image in place, which may be a SharedFramebuffer; the only copy is one float32 conversion)
     def save_image(self, full_filename):
+        image_single = self.rendered_image.astype(np.single)
         tonemapper = cv2.createTonemap(gamma=2.5)
-        image_nd_array_ldr = tonemapper.process(self.rendered_image.astype(np.single))
+        image_nd_array_ldr = tonemapper.process(image_single)
         plt.imsave(full_filename + '.png', np.clip(image_nd_array_ldr, 0, 1))
         np.save(full_filename, self.rendered_image)
-        cv2.imwrite(full_filename + '.hdr', cv2.cvtColor(self.rendered_image.astype('float32'), cv2.COLOR_RGB2BGR));
+        cv2.imwrite(full_filename + '.hdr', cv2.cvtColor(image_single, cv2.COLOR_RGB2BGR));
         print("Image Saved")
 
     # set pixel value
@@ -67,20 +453,81 @@ class Scene:
         self.rendered_image[y, x, 1] = pixel_val.g
         self.rendered_image[y, x, 2] = pixel_val.b
 
+    # set a block of pixels (tile_vals is an (h, w, 3) array with its upper left corner at (x0, y0))
+    def set_tile(self, tile_vals, x0, y0):
+        h, w = tile_vals.shape[:2]
+        self.rendered_image[y0:y0 + h, x0:x0 + w, :] = tile_vals
+
 
 # -------------------------------------------------Primitive classes
 class Primitive(ABC):
     def __init__(self, emission=BLACK):
         self.emission = emission
         self.BRDF = None
+        self.version = 0  # incremented by the setters, so a Scene can tell which primitives changed
 
     @abstractmethod
     def intersect(self, ray):
         pass
 
+    # Whether the ray hits the primitive within [t_min, t_max] (cheaper than intersect: no hit data is built)
+    def occluded(self, ray):
+        return self.intersect(ray).has_hit
+
+    # Axis-aligned bounding box as a tuple of (3,) np arrays (min, max), None for unbounded primitives
+    def get_bounds(self):
+        return None
+
+    # Shading frame (orthonormal basis) around a normal at a point of the primitive
+    def get_frame(self, normal):
+        return Frame(normal)
+
+    # Surface area, None for primitives that can not be sampled by area (unbounded ones)
+    def get_area(self):
+        return None
+
+    # Uniform sampling of the surface by area, for primitives with an area:
+    # sample_point returns a (point, normal) tuple of Vector3D from two uniform random numbers, sample_points the
+    # (N, 3) arrays of points and normals from an (N, 2) array of uniform random numbers
+    def sample_point(self, u1, u2):
+        points, normals = self.sample_points(np.array([[u1, u2]]))
+        return Vector3D(*points[0].tolist()), Vector3D(*normals[0].tolist())
+
+    def sample_points(self, u):
+        return self.sample_points_batch(self.pack([self]), np.zeros(len(u), dtype=np.int64), u)
+
+    # Batched version of sample_points over packed primitives (see pack): sample k is a point on the packed
+    # primitive index[k], from the uniform random numbers u[k]
+    @staticmethod
+    def sample_points_batch(packed, index, u):
+        raise NotImplementedError('This primitive type can not be sampled by area')
+
+    # Probability density (per unit area) of sampling a point of the surface with sample_point
+    def pdf(self, point):
+        return 1.0 / self.get_area()
+
+    # Pack a list of primitives of this type into contiguous parameter arrays (a dict of np arrays)
+    @staticmethod
+    @abstractmethod
+    def pack(primitives):
+        pass
+
+    # Batched intersection of a RayPacket (with normalized directions) against M packed primitives
+    # Returns the closest hit per ray as a tuple of arrays:
+    # (t (N,), hit mask (N,), index into the packed primitives (N,), normal (N, 3))
+    @staticmethod
+    @abstractmethod
+    def intersect_batch(packed, rays):
+        pass
+
     # Setters
     def set_BRDF(self, BRDF):
         self.BRDF = BRDF
+        self.version += 1
+
+    def set_emission(self, emission):
+        self.emission = emission
+        self.version += 1
 
     # Getters
     def get_BRDF(self):
@@ -127,6 +574,61 @@ class Sphere(Primitive):
         # Ray did not intersect sphere
         return HitData()
 
+    def occluded(self, ray):
+        ray_dir = Normalize(ray.d)
+        temp = ray.o - self.origin
+        B = 2.0 * Dot(ray_dir, temp)
+        C = Dot(temp, temp) - self.radius_squared
+        disc = (B * B) - (4.0 * C)  # Discriminant (A = 1 for a normalized direction)
+        if disc < 0.0:
+            return False
+        sqrt_disc = sqrt(disc)
+        t_small = (-B - sqrt_disc) / 2.0
+        if ray.t_min <= t_small <= ray.t_max:
+            return True
+        t_large = (-B + sqrt_disc) / 2.0
+        return ray.t_min <= t_large <= ray.t_max
+
+    def get_area(self):
+        return 4.0 * PI * self.radius_squared
+
+    @staticmethod
+    def sample_points_batch(packed, index, u):
+        z = 1.0 - 2.0 * u[:, 0]
+        r = np.sqrt(np.maximum(0.0, 1.0 - z * z))
+        phi = TWO_PI * u[:, 1]
+        normals = np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=-1)
+        return packed['center'][index] + packed['radius'][index, np.newaxis] * normals, normals
+
+    def get_bounds(self):
+        center = vector_to_array(self.origin)
+        return center - self.radius, center + self.radius
+
+    @staticmethod
+    def pack(primitives):
+        return {'center': np.array([vector_to_array(p.origin) for p in primitives]),
+                'radius': np.array([p.radius for p in primitives], dtype=np.float64),
+                'radius_squared': np.array([p.radius_squared for p in primitives], dtype=np.float64)}
+
+    @staticmethod
+    def intersect_batch(packed, rays):
+        center = packed['center']
+        d_dot_c = rays.d @ center.T  # (N, M)
+        o_dot_c = rays.o @ center.T  # (N, M)
+        # Directions are normalized, so A = 1
+        B = 2.0 * (np.einsum('ij,ij->i', rays.d, rays.o)[:, np.newaxis] - d_dot_c)
+        C = (np.einsum('ij,ij->i', rays.o, rays.o)[:, np.newaxis] - 2.0 * o_dot_c
+             + np.einsum('ij,ij->i', center, center)[np.newaxis, :] - packed['radius_squared'][np.newaxis, :])
+        disc = (B * B) - (4.0 * C)  # Discriminant
+        sqrt_disc = np.sqrt(np.maximum(disc, 0.0))
+        t_min = rays.t_min[:, np.newaxis]
+        t_max = rays.t_max[:, np.newaxis]
+        t_small = (-B - sqrt_disc) / 2.0
+        t_large = (-B + sqrt_disc) / 2.0
+        t = np.where((t_small >= t_min) & (t_small <= t_max), t_small, t_large)
+        t = np.where((disc >= 0.0) & (t >= t_min) & (t <= t_max), t, np.inf)
+        return closest_of_batch(t, rays, lambda index, p: (p - center[index]) / packed['radius'][index, np.newaxis])
+
 
 # Plane
 class InfinitePlane(Primitive):
@@ -135,6 +637,7 @@ class InfinitePlane(Primitive):
         super().__init__(emission)
         self.origin = plane_origin
         self.normal = Normalize(plane_normal)
+        self.frames = (Frame(self.normal), Frame(self.normal * -1.0))  # the normal is constant: frames of both sides
 
     # Member Functions
     # Returns tuple of (bool hit, distance, hit_point, normal)
@@ -153,6 +656,28 @@ class InfinitePlane(Primitive):
         # Ray did not intersect plane
         return HitData()
 
+    def get_frame(self, normal):
+        return self.frames[0] if Dot(normal, self.normal) > 0.0 else self.frames[1]
+
+    def occluded(self, ray):
+        ray_dir = Normalize(ray.d)
+        denominator = Dot(ray_dir, self.normal)
+        if denominator == 0.0:
+            return False
+        t = Dot(self.normal, (self.origin - ray.o)) / denominator
+        return ray.t_min <= t <= ray.t_max
+
+    @staticmethod
+    def pack(primitives):
+        return {'origin': np.array([vector_to_array(p.origin) for p in primitives]),
+                'normal': np.array([vector_to_array(p.normal) for p in primitives])}
+
+    @staticmethod
+    def intersect_batch(packed, rays):
+        normal = packed['normal']
+        t = plane_distances_batch(np.einsum('ij,ij->i', normal, packed['origin']), normal, rays)
+        return closest_of_batch(t, rays, lambda index, p: normal[index])
+
 
 # Plane
 class Parallelogram(Primitive):
@@ -167,6 +692,13 @@ class Parallelogram(Primitive):
         self.s1_l = Length(s1)
         self.s2_l = Length(s2)
         self.normal = Normalize(Cross(s1, s2))
+        # Dual vectors of the sides: a point p of the plane is point + (s1_d . (p - point)) s1 + (s2_d . (p - point)) s2
+        # (for a rectangle s1_d = s1 / |s1|^2), so it is inside if both coordinates are in [0, 1]
+        n = Cross(s1, s2)
+        n_squared = Dot(n, n)
+        self.s1_d = Cross(s2, n) / n_squared
+        self.s2_d = Cross(n, s1) / n_squared
+        self.frames = (Frame(self.normal), Frame(self.normal * -1.0))  # the normal is constant: frames of both sides
 
     # Member Functions
     # Returns tuple of (bool hit, distance, hit_point, normal)
@@ -181,18 +713,14 @@ class Parallelogram(Primitive):
         t = Dot(normal_, (self.point - ray.o)) / denominator
         if t >= ray.t_min and t <= ray.t_max:  # Hit
             p_hit = ray.get_hitpoint(t)
-            # Check whether p is within the square limits
+            # Check whether p is within the parallelogram limits
             p_ph = p_hit - self.point  # 3D vector from point to p_hit
 
-            # Project p_ph onto s1 and s2
-            p_ph_n = Normalize(p_ph)
-            p_ph_l = Length(p_ph)
-            cos_alpha1 = Dot(self.s1_n, p_ph_n)
-            cos_alpha2 = Dot(self.s2_n, p_ph_n)
-            q1 = cos_alpha1 * p_ph_l
-            q2 = cos_alpha2 * p_ph_l
+            # Coordinates of p_ph in the (s1, s2) basis
+            q1 = Dot(self.s1_d, p_ph)
+            q2 = Dot(self.s2_d, p_ph)
 
-            if q1 < 0.0 or q2 < 0.0 or q1 > self.s1_l or q2 > self.s2_l:
+            if q1 < 0.0 or q2 < 0.0 or q1 > 1.0 or q2 > 1.0:
                 return HitData()
 
             if Dot(self.normal, ray_dir) > 0:
@@ -202,6 +730,268 @@ class Parallelogram(Primitive):
         # Ray did not intersect plane
         return HitData()
 
+    def get_frame(self, normal):
+        return self.frames[0] if Dot(normal, self.normal) > 0.0 else self.frames[1]
+
+    def occluded(self, ray):
+        ray_dir = Normalize(ray.d)
+        denominator = Dot(ray_dir, self.normal)
+        if denominator == 0.0:
+            return False
+        t = Dot(self.normal, (self.point - ray.o)) / denominator
+        if t < ray.t_min or t > ray.t_max:
+            return False
+        # Coordinates of (p_hit - point) in the (s1, s2) basis, computed component-wise to avoid temporaries
+        px = ray.o.x + ray_dir.x * t - self.point.x
+        py = ray.o.y + ray_dir.y * t - self.point.y
+        pz = ray.o.z + ray_dir.z * t - self.point.z
+        q1 = self.s1_d.x * px + self.s1_d.y * py + self.s1_d.z * pz
+        if q1 < 0.0 or q1 > 1.0:
+            return False
+        q2 = self.s2_d.x * px + self.s2_d.y * py + self.s2_d.z * pz
+        return 0.0 <= q2 <= 1.0
+
+    def get_area(self):
+        return Length(Cross(self.s1, self.s2))
+
+    @staticmethod
+    def sample_points_batch(packed, index, u):
+        points = packed['point'][index] + u[:, 0:1] * packed['s1'][index] + u[:, 1:2] * packed['s2'][index]
+        return points, packed['normal'][index]
+
+    def get_bounds(self):
+        p = vector_to_array(self.point)
+        s1 = vector_to_array(self.s1)
+        s2 = vector_to_array(self.s2)
+        corners = np.array([p, p + s1, p + s2, p + s1 + s2])
+        return corners.min(axis=0), corners.max(axis=0)
+
+    @staticmethod
+    def pack(primitives):
+        return {'point': np.array([vector_to_array(p.point) for p in primitives]),
+                's1': np.array([vector_to_array(p.s1) for p in primitives]),
+                's2': np.array([vector_to_array(p.s2) for p in primitives]),
+                's1_d': np.array([vector_to_array(p.s1_d) for p in primitives]),
+                's2_d': np.array([vector_to_array(p.s2_d) for p in primitives]),
+                'normal': np.array([vector_to_array(p.normal) for p in primitives])}
+
+    @staticmethod
+    def intersect_batch(packed, rays):
+        normal = packed['normal']
+        point = packed['point']
+        t = plane_distances_batch(np.einsum('ij,ij->i', normal, point), normal, rays)
+        t_finite = np.where(np.isfinite(t), t, 0.0)
+        # Coordinates of (p_hit - point) in the (s1, s2) basis (dot products with the dual vectors) without building
+        # the (N, M, 3) hit points: (o + t * d - point) . s_d = (o . s_d - point . s_d) + t * (d . s_d)
+        for side in ('s1_d', 's2_d'):
+            s_d = packed[side]
+            q = (rays.o @ s_d.T - np.einsum('ij,ij->i', point, s_d)[np.newaxis, :]) + t_finite * (rays.d @ s_d.T)
+            t = np.where((q >= 0.0) & (q <= 1.0), t, np.inf)
+
+        def hit_normal(index, p):
+            n = normal[index]
+            facing = np.einsum('ij,ij->i', n, rays.d) > 0
+            return np.where(facing[:, np.newaxis], -n, n)
+        return closest_of_batch(t, rays, hit_normal)
+
+
+# -------------------------------------------------Bounding volume hierarchy
+BVH_MIN_PRIMITIVES = 16  # scenes with fewer bounded primitives than this are not worth a BVH
+BVH_N_BINS = 12  # number of centroid bins per axis used to evaluate the SAH
+BVH_MAX_LEAF_SIZE = 4  # nodes with more primitives than this are always split (when possible)
+BVH_TRAVERSAL_COST = 1.0  # SAH cost of visiting a node, relative to one primitive intersection
+BVH_BOX_PADDING = EPSILON  # boxes are padded so that flat primitives (axis-aligned walls) have some volume
+
+
+class BVH:
+    # Initializer
+    # primitive_indices: object_list indices of the bounded primitives
+    # bounds: list of (min, max) boxes of those primitives
+    # Nodes are stored flat in depth-first order: the left child of an interior node is the next node and
+    # node_offset holds the right child; for leaves node_offset is the first entry in primitive_order and
+    # node_count (> 0) the number of primitives
+    def __init__(self, primitive_indices, bounds):
+        self.box_min = np.array([b[0] for b in bounds]) - BVH_BOX_PADDING
+        self.box_max = np.array([b[1] for b in bounds]) + BVH_BOX_PADDING
+        self.centroids = (self.box_min + self.box_max) * 0.5
+        order = np.arange(len(primitive_indices))
+        node_min, node_max, node_offset, node_count, node_axis = [], [], [], [], []
+        stack = [(0, len(order), -1)]  # (start, end, parent waiting for its right child)
+        while stack:
+            start, end, parent = stack.pop()
+            node = len(node_offset)
+            if parent >= 0:
+                node_offset[parent] = node
+            items = order[start:end]
+            node_min.append(self.box_min[items].min(axis=0))
+            node_max.append(self.box_max[items].max(axis=0))
+            axis, split = self.find_split(items, node_min[-1], node_max[-1])
+            if axis < 0:  # Leaf
+                node_offset.append(start)
+                node_count.append(end - start)
+                node_axis.append(0)
+                continue
+            # Partition the primitives of the node
+            left = items[split]
+            right = items[~split]
+            order[start:end] = np.concatenate((left, right))
+            mid = start + len(left)
+            node_offset.append(-1)  # filled in when the right child is created
+            node_count.append(0)
+            node_axis.append(axis)
+            stack.append((mid, end, node))  # right child, built after the whole left subtree
+            stack.append((start, mid, -1))  # left child, next node in the array
+        self.node_min = np.array(node_min)
+        self.node_max = np.array(node_max)
+        self.node_offset = np.array(node_offset)
+        self.node_count = np.array(node_count)
+        self.node_axis = np.array(node_axis)
+        self.primitive_order = np.array(primitive_indices)[order]
+        # Python tuples for the scalar traversal (indexing np arrays one element at a time is slow):
+        # (min_x, min_y, min_z, max_x, max_y, max_z, offset, count, axis)
+        self.nodes = [tuple(b_min) + tuple(b_max) + (offset, count, axis) for b_min, b_max, offset, count, axis in
+                      zip(self.node_min.tolist(), self.node_max.tolist(), self.node_offset.tolist(),
+                          self.node_count.tolist(), self.node_axis.tolist())]
+        self.primitive_order_list = self.primitive_order.tolist()
+
+    # Binned SAH split of the primitives items (whose union box is [b_min, b_max])
+    # Returns (axis, mask of the items that go to the left child), or (-1, None) to make a leaf
+    def find_split(self, items, b_min, b_max):
+        n_items = len(items)
+        if n_items == 1:
+            return -1, None
+        centroids = self.centroids[items]
+        c_min = centroids.min(axis=0)
+        c_extent = centroids.max(axis=0) - c_min
+        leaf_cost = float(n_items)
+        best_cost, best_axis, best_bin, best_bins = np.inf, -1, -1, None
+        for axis in range(3):
+            if c_extent[axis] <= 0.0:
+                continue
+            bins = np.minimum(((centroids[:, axis] - c_min[axis]) / c_extent[axis] * BVH_N_BINS).astype(int),
+                              BVH_N_BINS - 1)
+            counts = np.bincount(bins, minlength=BVH_N_BINS)
+            bin_min = np.full((BVH_N_BINS, 3), np.inf)
+            bin_max = np.full((BVH_N_BINS, 3), -np.inf)
+            np.minimum.at(bin_min, bins, self.box_min[items])
+            np.maximum.at(bin_max, bins, self.box_max[items])
+            # Sweep from both sides to get the area and count of every candidate split
+            left_min = np.minimum.accumulate(bin_min, axis=0)[:-1]
+            left_max = np.maximum.accumulate(bin_max, axis=0)[:-1]
+            right_min = np.minimum.accumulate(bin_min[::-1], axis=0)[::-1][1:]
+            right_max = np.maximum.accumulate(bin_max[::-1], axis=0)[::-1][1:]
+            left_count = np.cumsum(counts)[:-1]
+            right_count = n_items - left_count
+            valid = (left_count > 0) & (right_count > 0)
+            if not np.any(valid):
+                continue
+            cost = np.full(BVH_N_BINS - 1, np.inf)
+            cost[valid] = BVH_TRAVERSAL_COST + (
+                box_area(left_min[valid], left_max[valid]) * left_count[valid] +
+                box_area(right_min[valid], right_max[valid]) * right_count[valid]) / box_area(b_min, b_max)
+            i = int(np.argmin(cost))
+            if cost[i] < best_cost:
+                best_cost, best_axis, best_bin, best_bins = cost[i], axis, i, bins
+        if best_axis < 0 or (best_cost >= leaf_cost and n_items <= BVH_MAX_LEAF_SIZE):
+            return -1, None
+        return best_axis, best_bins <= best_bin
+
+    # Slab test of the ray (origin o, inverse direction inv_d) against a node box, within [t_min, t_max]
+    @staticmethod
+    def hit_box(node, o, inv_d, t_min, t_max):
+        for axis in range(3):
+            t0 = (node[axis] - o[axis]) * inv_d[axis]
+            t1 = (node[axis + 3] - o[axis]) * inv_d[axis]
+            if t0 > t1:
+                t0, t1 = t1, t0
+            if t0 > t_min:
+                t_min = t0
+            if t1 < t_max:
+                t_max = t1
+            if t_min > t_max:
+                return False
+        return True
+
+    # Returns the ray origin and inverse normalized direction as tuples (for the slab tests)
+    @staticmethod
+    def setup_ray(ray):
+        d = Normalize(ray.d)
+        inv_d = tuple(1.0 / c if c != 0.0 else HUGEVALUE * HUGEVALUE for c in (d.x, d.y, d.z))
+        return (ray.o.x, ray.o.y, ray.o.z), inv_d
+
+    # Closest hit along the ray, starting from hit_data (the closest hit found so far)
+    def closest_hit(self, ray, object_list, hit_data):
+        o, inv_d = self.setup_ray(ray)
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            node = self.nodes[index]
+            if not self.hit_box(node, o, inv_d, ray.t_min, min(ray.t_max, hit_data.hit_distance)):
+                continue
+            offset, count = node[6], node[7]
+            if count > 0:  # Leaf
+                for i in self.primitive_order_list[offset:offset + count]:
+                    this_hit = object_list[i].intersect(ray)
+                    if this_hit.has_hit and this_hit.hit_distance < hit_data.hit_distance:
+                        hit_data = this_hit
+                        hit_data.primitive_index = i
+            elif inv_d[node[8]] < 0.0:  # visit the near child first
+                stack.append(index + 1)
+                stack.append(offset)
+            else:
+                stack.append(offset)
+                stack.append(index + 1)
+        return hit_data
+
+    # Index of the first primitive found that blocks the ray (stops at the first hit), or -1
+    def find_occluder(self, ray, object_list):
+        o, inv_d = self.setup_ray(ray)
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            node = self.nodes[index]
+            if not self.hit_box(node, o, inv_d, ray.t_min, ray.t_max):
+                continue
+            offset, count = node[6], node[7]
+            if count > 0:  # Leaf
+                for i in self.primitive_order_list[offset:offset + count]:
+                    if object_list[i].occluded(ray):
+                        return i
+            else:
+                stack.append(offset)
+                stack.append(index + 1)
+        return -1
+
+
+# Surface area of the boxes [b_min, b_max] (works on (3,) and (K, 3) arrays)
+def box_area(b_min, b_max):
+    e = b_max - b_min
+    return 2.0 * (e[..., 0] * e[..., 1] + e[..., 1] * e[..., 2] + e[..., 2] * e[..., 0])
+
+
+# -------------------------------------------------Batched intersection helpers
+# Distances from each ray to M planes given by their normals (M, 3) and offsets n . p (M,)
+# Returns an (N, M) array where misses (parallel rays or t outside [t_min, t_max]) are set to inf
+def plane_distances_batch(offsets, normals, rays):
+    denominator = rays.d @ normals.T  # (N, M)
+    numerator = offsets[np.newaxis, :] - rays.o @ normals.T
+    parallel = denominator == 0.0
+    t = numerator / np.where(parallel, 1.0, denominator)
+    return np.where(~parallel & (t >= rays.t_min[:, np.newaxis]) & (t <= rays.t_max[:, np.newaxis]), t, np.inf)
+
+
+# Reduce an (N, M) array of hit distances to the closest hit per ray
+# normal_fn(index, hit_points) computes the (unnormalized) normals of the hit primitives
+def closest_of_batch(t, rays, normal_fn):
+    index = np.argmin(t, axis=1)
+    t_best = t[np.arange(len(rays)), index]
+    hit = np.isfinite(t_best)
+    normal = np.zeros((len(rays), 3))
+    if np.any(hit):
+        n = normal_fn(index, rays.get_hitpoints(np.where(hit, t_best, 0.0)))
+        normal[hit] = n[hit] / np.linalg.norm(n[hit], axis=1)[:, np.newaxis]
+    return t_best, hit, index, normal
+
 
 # -------------------------------------------------BRDF classes
 class BRDF(ABC):
@@ -230,6 +1020,7 @@ class PointLight:
     def __init__(self, pos_, intensity_):
         self.pos = pos_
         self.intensity = intensity_
+        self.last_occluder = -1  # shadow cache: object_list index of the primitive that last blocked this light
 
 
 # -------------------------------------------------Camera Class
@@ -253,3 +1044,36 @@ class Camera:
         # Compute the ray direction in camera space
         direction = Normalize(p_cs)  # because camera is always at (0,0,0)
         return direction
+
+    # Batched version of get_direction: xs and ys are arrays of pixel coordinates, returns an (N, 3) array
+    def get_directions(self, xs, ys):
+        x_ss = 2.0 * (xs + 0.5) / self.width - 1.0
+        y_ss = 1.0 - 2.0 * (ys + 0.5) / self.height
+        tan_half_fov = tan(self.vertical_fov / 2.0)
+        p_cs = np.empty((len(xs), 3))
+        p_cs[:, 0] = x_ss * tan_half_fov * self.aspect_ratio
+        p_cs[:, 1] = y_ss * tan_half_fov
+        p_cs[:, 2] = -1.0
+        return p_cs * (1.0 / np.linalg.norm(p_cs, axis=1))[:, np.newaxis]
+
+    # Generate the camera rays of the pixels with the given flat indices (y * width + x) as a RayPacket
+    def generate_pixel_rays(self, pixel_index):
+        ys, xs = np.divmod(pixel_index, self.width)
+        return RayPacket(np.zeros(3), self.get_directions(xs, ys), pixel_index=pixel_index)
+
+    # Generate the camera rays of the tile [x0, x1) x [y0, y1) as a RayPacket (row-major pixel order)
+    def generate_rays(self, x0, y0, x1, y1):
+        ys, xs = np.mgrid[y0:y1, x0:x1]
+        xs = xs.ravel()
+        ys = ys.ravel()
+        directions = self.get_directions(xs, ys)
+        return RayPacket(np.zeros(3), directions, pixel_index=ys * self.width + xs)
+
+    # Split the image plane into tiles of (at most) tile_size x tile_size pixels
+    # Returns a list of (x0, y0, x1, y1) tuples
+    def get_tiles(self, tile_size):
+        tiles = []
+        for y0 in range(0, self.height, tile_size):
+            for x0 in range(0, self.width, tile_size):
+                tiles.append((x0, y0, min(x0 + tile_size, self.width), min(y0 + tile_size, self.height)))
+        return tiles
@@ -1,5 +1,24 @@
 from PyRT_Common import *
 from random import randint
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from multiprocessing import shared_memory
+import json
+import os
+import shutil
+import time
+
+TILE_SIZE = 32  # side (in pixels) of the square tiles used by the tiled render modes
+RENDER_SEED = 0  # default seed of the tiled render modes
+MAX_BATCH_RAYS = 2 ** 16  # largest RayPacket of sample rays traced at once by the batched integrators
+MIS_HEURISTICS = ('balance', 'power')  # sample combination heuristics of MISIntegrator
+LIGHT_VISIBILITY_TOLERANCE = 1e-4  # relative distance tolerance when testing that a sampled light point is visible
+CHECKPOINT_INTERVAL = 60.0  # default minimum time (in seconds) between two render checkpoints
+PROGRESSIVE_MIN_LUMINANCE = 1e-3  # floor of the pixel luminance used to compute relative errors (dark pixels)
+PROGRESSIVE_MIN_SAMPLES = 64  # samples a pixel needs before its estimated error can stop it (error_threshold)
+PATH_MAX_DEPTH = 16  # default maximum number of bounces of the paths of PathTracingIntegrator
+PATH_RR_DEPTH = 3  # default number of bounces before Russian roulette starts
+PATH_RR_MAX_SURVIVAL = 0.95  # highest probability of a path surviving Russian roulette (bounds the path length)
 
 
 # -------------------------------------------------
@@ -15,6 +34,15 @@ class Integrator(ABC):
         self.filename = filename_ + experiment_name
         # self.env_map = None  # not initialized
         self.scene = None
+        self.sampler = None  # Sampler of the pixel samples (None: IndependentSampler seeded with the render seed)
+        self.render_sampler = None  # Sampler of the current render (set by the render loops)
+
+    # What the secondary rays of the integrator can reach, one of SECONDARY_RAYS (see Scene.find_dirty_pixels):
+    # decides which pixels render_incremental shades again after a change of the scene
+    secondary_rays = 'paths'
+    # Whether the integrator chooses lights with the emitter index of the scene (Scene.sample_lights): then a change
+    # of the light selection probabilities affects every pixel
+    light_selection = False
 
     @abstractmethod
     def compute_color(self, ray):
@@ -28,35 +56,370 @@ class Integrator(ABC):
     def get_filename(self):
         return self.filename
 
-    # Simple render loop: launches 1 ray per pixel
-    def render(self):
+    def set_sampler(self, sampler):
+        self.sampler = sampler
+
+    # Batched version of compute_color: takes a RayPacket and returns an (N, 3) array with the radiance of each ray
+    # Integrators without a vectorized implementation fall back to the per-ray reference path
+    def compute_color_batch(self, rays):
+        colors = np.zeros((len(rays), 3))
+        for i in range(len(rays)):
+            pixel = self.compute_color(rays.get_ray(i))
+            colors[i] = (pixel.r, pixel.g, pixel.b)
+        return colors
+
+    # Color of a single ray computed by compute_color_batch on a packet of one ray (for the integrators that are only
+    # implemented in batches)
+    def compute_color_via_batch(self, ray):
+        rays = RayPacket(vector_to_array(ray.o), vector_to_array(Normalize(ray.d))[np.newaxis, :], ray.t_max)
+        color = self.compute_color_batch(rays)[0].tolist()
+        return RGBColor(color[0], color[1], color[2])
+
+    # (len(indices), n_samples, n_dims) points in [0, 1) for the samples [sample_start, sample_start + n_samples)
+    # of the rays[indices] of a packet: from the render sampler (one point set per pixel) when the rays know their
+    # pixel, so every pixel sample is the same in any render mode, or from the global generator otherwise
+    def random_uniforms(self, rays, indices, n_samples, n_dims=2, sample_start=0):
+        if self.render_sampler is None or rays.pixel_index is None:
+            return np.random.rand(len(indices), n_samples, n_dims)
+        return self.render_sampler.generate(rays.pixel_index[indices], n_samples, n_dims, sample_start)
+
+    def init_render_sampler(self, seed):
+        self.render_sampler = self.sampler if self.sampler is not None else IndependentSampler(seed)
+
+    # Incoming radiance along the rays given by two (K, 3) arrays of origins and directions: the emission of the
+    # closest primitive hit, or the environment map (black without one) when nothing is hit
+    # The rays are traced as RayPackets of at most MAX_BATCH_RAYS rays
+    # env_level: mip level of the environment map lookups (see EnvironmentMap.lookup), one for all the rays or a (K,)
+    # array
+    def trace_radiance_batch(self, origins, directions, env_level=0.0):
+        emission, kd = self.scene.get_material_arrays()
+        env_map = self.scene.env_map
+        env_level = np.broadcast_to(env_level, (len(directions),))
+        l_i = np.zeros((len(directions), 3))
+        for start in range(0, len(directions), MAX_BATCH_RAYS):
+            chunk = slice(start, start + MAX_BATCH_RAYS)
+            r = RayPacket(origins[chunk], directions[chunk])
+            r_hit = self.scene.closest_hit_batch(r)
+            l_chunk = l_i[chunk]
+            l_chunk[r_hit.has_hit] = emission[r_hit.primitive_index[r_hit.has_hit]]
+            if env_map is not None:
+                l_chunk[~r_hit.has_hit] = env_map.lookup(r.d[~r_hit.has_hit], level=env_level[chunk][~r_hit.has_hit])
+        return l_i
+
+    # Closest hits of the rays given by two (K, 3) arrays of origins and directions (traced in RayPackets of at most
+    # MAX_BATCH_RAYS rays), as a BatchHitData
+    def closest_hits(self, origins, directions):
+        hit_data = BatchHitData(len(directions))
+        for start in range(0, len(directions), MAX_BATCH_RAYS):
+            chunk = slice(start, start + MAX_BATCH_RAYS)
+            chunk_hits = self.scene.closest_hit_batch(RayPacket(origins[chunk], directions[chunk]))
+            hit_data.has_hit[chunk] = chunk_hits.has_hit
+            hit_data.hit_point[chunk] = chunk_hits.hit_point
+            hit_data.normal[chunk] = chunk_hits.normal
+            hit_data.hit_distance[chunk] = chunk_hits.hit_distance
+            hit_data.primitive_index[chunk] = chunk_hits.primitive_index
+        return hit_data
+
+    # Shade the tile [x0, x1) x [y0, y1), returns an (h, w, 3) array
+    # packet=True shades all the camera rays of the tile with compute_color_batch, otherwise 1 ray per pixel
+    # If a seed is given the random number generators are seeded with it before shading the tile
+    def render_tile(self, x0, y0, x1, y1, packet=True, seed=None):
+        if seed is not None:
+            seed_rngs(seed)
+        cam = self.scene.camera
+        if packet:
+            rays = cam.generate_rays(x0, y0, x1, y1)
+            colors = self.compute_color_batch(rays)
+            return colors.reshape((y1 - y0, x1 - x0, 3))
+        tile_vals = np.zeros((y1 - y0, x1 - x0, 3))
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                pixel = self.compute_color(Ray(direction=cam.get_direction(x, y)))
+                tile_vals[y - y0, x - x0] = (pixel.r, pixel.g, pixel.b)
+        return tile_vals
+
+    # Render loop
+    # By default launches 1 ray per pixel through compute_color (reference implementation)
+    # With packet=True or n_workers != 1 the image plane is split into tiles:
+    # - packet=True generates the camera rays of each tile at once and shades them with compute_color_batch
+    # - n_workers > 1 (None = all cores) renders the tiles in a pool of worker processes; the integrator and its
+    #   scene are sent once to each worker, and the workers write their tiles directly into a SharedFramebuffer.
+    #   Every tile seeds the random number generators from (seed, tile index) so the image does not depend on
+    #   the number of workers
+    # checkpoint=path periodically saves the finished tiles to a RenderCheckpoint (this also renders by tiles, as
+    # the tile seeds make a resumed render identical to an uninterrupted one), and resume=path continues the
+    # render saved there. The checkpoint is removed once the image is saved
+    def render(self, packet=False, tile_size=TILE_SIZE, n_workers=1, seed=RENDER_SEED, checkpoint=None,
+               resume=None):
         # YOU MUST CHANGE THIS METHOD IN ASSIGNMENTS 1.1 and 1.2:
         cam = self.scene.camera  # camera object
         # ray = Ray()
         print('Rendering Image: ' + self.get_filename())
-        for x in range(0, cam.width):
-            for y in range(0, cam.height):
-                direction = cam.get_direction(x, y)
-                ray = Ray(direction=direction)
-                pixel = self.compute_color(ray)
-                self.scene.set_pixel(pixel, x, y)  # save pixel to pixel array
-            progress = (x / cam.width) * 100
-            print('\r\tProgress: ' + str(progress) + '%', end='')
-        # save image to file
-        print('\r\tProgress: 100% \n\t', end='')
-        full_filename = self.get_filename()
-        self.scene.save_image(full_filename)
+        self.scene.update()  # build the acceleration data once, before the scene is sent to the workers
+        self.init_render_sampler(seed)
+        checkpoint_path = resume if resume is not None else checkpoint
+        tiles = None
+        if packet or n_workers != 1 or checkpoint_path is not None:
+            tiles = cam.get_tiles(tile_size)
+            tile_done = np.zeros(len(tiles), dtype=bool)
+        checkpointer = None
+        if checkpoint_path is not None:
+            checkpointer = RenderCheckpoint(checkpoint_path, {'mode': 'tiles', 'filename': self.get_filename(),
+                                                              'width': cam.width, 'height': cam.height,
+                                                              'tile_size': tile_size, 'packet': packet, 'seed': seed})
+            if resume is not None:
+                state, buffers = checkpointer.load()
+                self.scene.rendered_image[:] = buffers['image']
+                tile_done = buffers['tile_done']
+        # Parallel renders keep the image in shared memory until it is saved
+        framebuffer = SharedFramebuffer(self.scene) if n_workers != 1 else nullcontext()
+        with framebuffer:
+            if n_workers != 1:
+                progress = ProgressBar(len(tiles))
+                progress.update(int(np.sum(tile_done)))
+                with ProcessPoolExecutor(max_workers=n_workers, initializer=init_render_worker,
+                                         initargs=(self, framebuffer)) as pool:
+                    futures = {pool.submit(render_tile_worker, tile, packet, tile_seed(seed, i)): i
+                               for i, tile in enumerate(tiles) if not tile_done[i]}
+                    for future in as_completed(futures):
+                        future.result()
+                        self.finish_tile(checkpointer, tile_done, futures[future])
+                        progress.update()
+            elif tiles is not None:
+                progress = ProgressBar(len(tiles))
+                progress.update(int(np.sum(tile_done)))
+                for i, (x0, y0, x1, y1) in enumerate(tiles):
+                    if tile_done[i]:
+                        continue
+                    self.scene.set_tile(self.render_tile(x0, y0, x1, y1, packet, tile_seed(seed, i)), x0, y0)
+                    self.finish_tile(checkpointer, tile_done, i)
+                    progress.update()
+            else:
+                progress = ProgressBar(cam.width)
+                for x in range(0, cam.width):
+                    for y in range(0, cam.height):
+                        direction = cam.get_direction(x, y)
+                        ray = Ray(direction=direction)
+                        pixel = self.compute_color(ray)
+                        self.scene.set_pixel(pixel, x, y)  # save pixel to pixel array
+                    progress.update()
+            # save image to file
+            progress.finish()
+            full_filename = self.get_filename()
+            self.scene.save_image(full_filename)
+        if checkpointer is not None:
+            checkpointer.remove()
+
+    # Incremental render: only the pixels that the changes of the scene since the last incremental render of this
+    # integrator can affect (Scene.find_dirty_pixels, with the secondary_rays of the integrator) are shaded again,
+    # the others keep their value. The first call, and any call after a change that affects every pixel (camera,
+    # environment map, ambient light, Scene.mark_all_dirty), renders the whole image with render(packet=True)
+    # The dirty pixels are shaded in packets of tile_size^2 rays with compute_color_batch, so the integrators whose
+    # samples come from random_uniforms give them the same value as a full render. The other pixels are only
+    # guaranteed to keep the value of a full render for the changes that find_dirty_pixels tracks: geometry,
+    # materials, emissions and point lights marked dirty, and the light selection of the integrators that use it
+    # (light_selection). Anything else needs Scene.mark_all_dirty
+    def render_incremental(self, tile_size=TILE_SIZE, seed=RENDER_SEED):
+        scene = self.scene
+        key = (self.get_filename(), seed)
+        if scene.render_record != key or scene.full_update:
+            self.render(packet=True, tile_size=tile_size, seed=seed)
+            scene.record_render(key)
+            return
+        print('Rendering Image (incremental): ' + self.get_filename())
+        dirty, hit_buffers = scene.find_dirty_pixels(self.secondary_rays, self.light_selection)
+        dirty = np.flatnonzero(dirty)
+        scene.update()
+        self.init_render_sampler(seed)
+        batch_size = tile_size * tile_size
+        image = scene.rendered_image.reshape((-1, 3))  # view of the image, indexed by the flat pixel index
+        progress = ProgressBar((len(dirty) + batch_size - 1) // batch_size)
+        for start in range(0, len(dirty), batch_size):
+            pixels = dirty[start:start + batch_size]
+            image[pixels] = self.compute_color_batch(scene.camera.generate_pixel_rays(pixels))
+            progress.update()
+        progress.finish()
+        print(str(len(dirty)) + ' of ' + str(len(image)) + ' pixels rendered')
+        scene.save_image(self.get_filename())
+        scene.record_render(key, hit_buffers)
+
+    # Mark tile i as finished, and save a checkpoint if it is time to
+    # (the tiles are seeded from the render seed, so no random number generator state has to be saved)
+    def finish_tile(self, checkpointer, tile_done, i):
+        if checkpointer is None:
+            return
+        tile_done[i] = True
+        checkpointer.maybe_save({'image': self.scene.rendered_image, 'tile_done': tile_done}, dict)
+
+
+# -------------------------------------------------Worker processes for the parallel render
+# The integrator (and its scene, without its image, see Scene.__getstate__) is unpickled once per worker by the
+# pool initializer, and its scene renders into the SharedFramebuffer of the parent process
+worker_integrator = None
+
+
+def init_render_worker(integrator, framebuffer):
+    global worker_integrator
+    worker_integrator = integrator
+    worker_integrator.scene.rendered_image = framebuffer.image
+
+
+def render_tile_worker(tile, packet, seed):
+    x0, y0, x1, y1 = tile
+    worker_integrator.scene.set_tile(worker_integrator.render_tile(x0, y0, x1, y1, packet, seed), x0, y0)
+    return tile
+
+
+# Seed of a tile, derived from the render seed and the tile index
+def tile_seed(seed, tile_index):
+    return int(np.random.SeedSequence([seed, tile_index]).generate_state(1)[0])
+
+
+# -------------------------------------------------Shared memory framebuffer (for parallel renders)
+# Context manager that moves Scene.rendered_image into a multiprocessing.shared_memory segment, so that worker
+# processes can write their tiles into it directly. On exit the image is copied back to a private array and the
+# segment is always released (closed and unlinked), also when rendering fails
+class SharedFramebuffer:
+    # Initializer
+    def __init__(self, scene):
+        self.scene = scene
+        self.shape = scene.rendered_image.shape
+        self.shm = None
+        self.image = None  # (height, width, 3) view of the shared segment
+        self.owner = True  # only the process that created the segment unlinks it
+
+    def __enter__(self):
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)) * 8)
+        self.image = np.ndarray(self.shape, dtype=np.float64, buffer=self.shm.buf)
+        self.image[:] = self.scene.rendered_image
+        self.scene.rendered_image = self.image
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.scene.rendered_image = np.array(self.image)
+        self.release()
+        return False
+
+    def release(self):
+        self.image = None  # drop the view, the segment can not be closed while it is exported
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    # Pickling (spawn-based worker processes) attaches to the existing segment by name
+    def __reduce__(self):
+        return attach_shared_framebuffer, (self.shm.name, self.shape)
+
+
+# Attach to a SharedFramebuffer created by another process
+def attach_shared_framebuffer(name, shape):
+    framebuffer = SharedFramebuffer.__new__(SharedFramebuffer)
+    framebuffer.scene = None
+    framebuffer.shape = shape
+    framebuffer.shm = shared_memory.SharedMemory(name=name)
+    framebuffer.image = np.ndarray(shape, dtype=np.float64, buffer=framebuffer.shm.buf)
+    framebuffer.owner = False
+    return framebuffer
+
+
+# -------------------------------------------------Render checkpoints (to resume long renders)
+# A checkpoint is a directory with the render buffers stored as memory-mapped .npy files and a checkpoint.json
+# file with the render parameters (metadata, checked on resume) and the state needed to continue the render.
+# Buffers are written in two alternating slots and checkpoint.json (replaced atomically) names the last complete
+# one, so a crash while saving never corrupts the previous checkpoint
+class RenderCheckpoint:
+    # Initializer
+    # metadata: JSON serializable dict identifying the render (a checkpoint is only resumed by the same render)
+    def __init__(self, path, metadata, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.metadata = metadata
+        self.interval = interval  # minimum time (in seconds) between two checkpoints saved by maybe_save
+        self.slot = None  # slot of the last saved buffers
+        self.last_save_time = time.time()
+
+    def buffer_filename(self, name, slot):
+        return os.path.join(self.path, name + '_' + str(slot) + '.npy')
+
+    # Return the (state, buffers) of the last saved checkpoint, buffers being a dict of np arrays
+    def load(self):
+        with open(os.path.join(self.path, 'checkpoint.json')) as f:
+            saved = json.load(f)
+        if saved['metadata'] != json.loads(json.dumps(self.metadata)):
+            raise ValueError('The checkpoint in ' + self.path + ' belongs to a different render: ' +
+                             str(saved['metadata']))
+        self.slot = saved['slot']
+        buffers = {name: np.array(np.load(self.buffer_filename(name, self.slot), mmap_mode='r'))
+                   for name in saved['buffers']}
+        return saved['state'], buffers
+
+    # Save the buffers (dict of np arrays) and the state (JSON serializable dict)
+    def save(self, buffers, state):
+        slot = 0 if self.slot != 0 else 1
+        os.makedirs(self.path, exist_ok=True)
+        for name, array in buffers.items():
+            stored = np.lib.format.open_memmap(self.buffer_filename(name, slot), mode='w+', dtype=array.dtype,
+                                               shape=array.shape)
+            stored[:] = array
+            stored.flush()
+            del stored
+        checkpoint_filename = os.path.join(self.path, 'checkpoint.json')
+        with open(checkpoint_filename + '.tmp', 'w') as f:
+            json.dump({'metadata': self.metadata, 'state': state, 'slot': slot, 'buffers': list(buffers)}, f)
+        os.replace(checkpoint_filename + '.tmp', checkpoint_filename)
+        self.slot = slot
+        self.last_save_time = time.time()
+
+    # Save a checkpoint if the last one is older than the checkpoint interval (state_fn returns the state)
+    def maybe_save(self, buffers, state_fn):
+        if time.time() - self.last_save_time >= self.interval:
+            self.save(buffers, state_fn())
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+# -------------------------------------------------Text progress bar
+class ProgressBar:
+    def __init__(self, total, width=40):
+        self.total = total
+        self.width = width
+        self.done = 0
+        self.start_time = time.time()
+        self.show()
+
+    def update(self, n=1):
+        self.done += n
+        self.show()
+
+    def show(self):
+        fraction = self.done / self.total if self.total > 0 else 1.0
+        filled = int(fraction * self.width)
+        elapsed = time.time() - self.start_time
+        print('\r\tProgress: [' + '#' * filled + '-' * (self.width - filled) + '] ' +
+              f'{fraction * 100:.1f}% ({elapsed:.1f}s)', end='')
+
+    def finish(self):
+        if self.done != self.total:
+            self.done = self.total
+            self.show()
+        print(' \n\t', end='')
 
 
 class LazyIntegrator(Integrator):
+    secondary_rays = 'none'
+
     def __init__(self, filename_):
         super().__init__(filename_ + '_Lazy')
 
     def compute_color(self, ray):
         return BLACK
 
+    def compute_color_batch(self, rays):
+        return np.zeros((len(rays), 3))
+
 
 class IntersectionIntegrator(Integrator):
+    secondary_rays = 'none'
 
     def __init__(self, filename_):
         super().__init__(filename_ + '_Intersection')
@@ -65,8 +428,14 @@ class IntersectionIntegrator(Integrator):
         # ASSIGNMENT 1.2: PUT YOUR CODE HERE
         return RED if self.scene.any_hit(ray) else BLACK
 
+    def compute_color_batch(self, rays):
+        colors = np.zeros((len(rays), 3))
+        colors[self.scene.any_hit_batch(rays)] = color_to_array(RED)
+        return colors
+
 
 class DepthIntegrator(Integrator):
+    secondary_rays = 'none'
 
     def __init__(self, filename_, max_depth_=10):
         super().__init__(filename_ + '_Depth')
@@ -83,8 +452,15 @@ class DepthIntegrator(Integrator):
         depth_color = max(0, depth_color)
         return RGBColor(depth_color, depth_color, depth_color)
 
+    def compute_color_batch(self, rays):
+        hit_data = self.scene.closest_hit_batch(rays)
+        depth_color = np.maximum(0, 1 - (hit_data.hit_distance / self.max_depth))
+        depth_color[~hit_data.has_hit] = 0.0
+        return np.repeat(depth_color[:, np.newaxis], 3, axis=1)
+
 
 class NormalIntegrator(Integrator):
+    secondary_rays = 'none'
 
     def __init__(self, filename_):
         super().__init__(filename_ + '_Normal')
@@ -101,11 +477,37 @@ class NormalIntegrator(Integrator):
         color_components = (normal + ONE) / 2
         return RGBColor(color_components.x, color_components.y, color_components.z)
 
+    def compute_color_batch(self, rays):
+        hit_data = self.scene.closest_hit_batch(rays)
+        colors = (hit_data.normal + 1.0) / 2
+        colors[~hit_data.has_hit] = 0.0
+        return colors
+
 
 class PhongIntegrator(Integrator):
+    secondary_rays = 'lights'
 
-    def __init__(self, filename_):
+    # light_samples: if None every point light is evaluated at each shading point; otherwise that many lights are
+    # chosen with the emitter index of the scene (Scene.sample_light) and their contributions are divided by
+    # light_samples and by their selection probability (an unbiased, noisy estimate of the sum over the lights)
+    def __init__(self, filename_, light_samples=None):
         super().__init__(filename_ + '_Phong')
+        self.light_samples = light_samples
+        self.light_selection = light_samples is not None
+
+    # (point light, weight of its contribution) pairs shaded at a hit point
+    def shading_lights(self):
+        if self.light_samples is None:
+            return [(light_source, 1.0) for light_source in self.scene.pointLights]
+        if self.scene.n_lights() == 0:
+            return []
+        lights = []
+        for _ in range(self.light_samples):
+            light, probability = self.scene.sample_light(random())
+            point_light = self.scene.light_point[light]
+            if point_light >= 0:  # emissive primitives are not shaded by the Phong model
+                lights.append((self.scene.pointLights[point_light], 1.0 / (self.light_samples * probability)))
+        return lights
 
     def compute_color(self, ray):
         # ASSIGNMENT 1.4: PUT YOUR CODE HERE
@@ -129,40 +531,60 @@ class PhongIntegrator(Integrator):
         ambient_light = kd.multiply(self.scene.i_a)
         accumulated_color = ambient_light
 
-        # Loop through all light sources
-        for light_source in self.scene.pointLights:
+        # Loop through the light sources (all of them, or the sampled ones)
+        for light_source, light_weight in self.shading_lights():
             # Light source details
             light_vec = light_source.pos - hit_data.hit_point
             dist_from_light = Length(light_vec)
-            incident_intensity = light_source.intensity / dist_from_light**2
+            incident_intensity = light_source.intensity / (dist_from_light**2 / light_weight)
             w_i = Normalize(light_vec)
 
             # Shadow check
             shadow_ray = Ray(hit_data.hit_point, w_i, dist_from_light)
-            if self.scene.any_hit(shadow_ray):
+            if self.scene.any_hit(shadow_ray, light_source):
                 continue
 
             # Diffuse light = kd * I / d^2 * max(0, n.l)
-            diffuse_light = kd.multiply(incident_intensity) * max(0, Dot(normal, w_i))
+            n_dot_l = Dot(normal, w_i)
+            accumulated_color.iadd_scaled(kd.multiply(incident_intensity), max(0, n_dot_l))
 
             # Specular light = ks * I / d^2 * max(0, r.w_o)^s
-            two_n_dot_l = 2.0 * Dot(normal, w_i)
-            r = Normalize(normal * two_n_dot_l - w_i)  # r = 2 * n.l * n - w_i
-            specular_light = ks.multiply(incident_intensity) * max(0, Dot(w_o, r)) ** shininess
-
-            accumulated_color = accumulated_color + diffuse_light + specular_light
+            r = (ScaleByDot(normal, normal, w_i, 2.0) - w_i).normalize_in_place()  # r = 2 * n.l * n - w_i
+            accumulated_color.iadd_scaled(ks.multiply(incident_intensity), max(0, Dot(w_o, r)) ** shininess)
 
         return accumulated_color
 
 
 class CMCIntegrator(Integrator):  # Classic Monte Carlo Integrator
+    secondary_rays = 'hemisphere'
 
-    def __init__(self, n, filename_, experiment_name=''):
+    # env_map_sampling: sample the directions proportionally to the environment map (EnvironmentMap.sample)
+    # instead of uniformly over the hemisphere. Directions below the surface contribute zero, and emitters are
+    # only found where the environment map is not black
+    # control_variate: SH order (0 is a constant, up to SH_MAX_ORDER) of an approximation of the environment map used
+    # as a control variate: the samples of L~ * brdf * cos / p, whose integral kd * E~(n) is known
+    # (EnvironmentMap.sh_irradiance), are subtracted with the optimal coefficient of each pixel
+    # (see control_variate_estimates). None (default) is the plain estimator; render_progressive always uses it
+    # prefiltered: the samples that reach the environment map fetch it at the mip level of their footprint, a solid
+    # angle of 1 / (n p(omega)) (EnvironmentMap.level_for_solid_angle), instead of its full resolution texels:
+    # less variance for a small bias (a blur of the lighting). Ignored with env_map_sampling, whose directions
+    # already follow the map (blurring it around them only adds bias)
+    def __init__(self, n, filename_, experiment_name='', env_map_sampling=False, control_variate=None,
+                 prefiltered=False):
         filename_mc = filename_ + '_MC_' + str(n) + '_samples' + experiment_name
         super().__init__(filename_mc)
+        self.base_filename = filename_
+        self.experiment_name = experiment_name
         self.n_samples = n
+        self.env_map_sampling = env_map_sampling
+        self.control_variate = control_variate
+        self.prefiltered = prefiltered
 
     def compute_color(self, ray):
+        if self.control_variate is not None or (self.prefiltered and not self.env_map_sampling):
+            # the control variate estimator needs all the samples of the pixel, and the mip levels are only fetched
+            # in batches: run them on a packet of one ray
+            return self.compute_color_via_batch(ray)
         hit_data = self.scene.closest_hit(ray)
 
         # If no hit, return the environment map value or black
@@ -176,14 +598,28 @@ class CMCIntegrator(Integrator):  # Classic Monte Carlo Integrator
         hit_object = self.scene.object_list[hit_data.primitive_index]
         brdf = hit_object.get_BRDF().kd
 
-        # Generate sample set and probabilities
-        pdf = UniformPDF()
-        sample_set, sample_prob = sample_set_hemisphere(self.n_samples, pdf)
+        # Generate sample set (world space directions) and probabilities
+        if self.env_map_sampling and self.scene.env_map is not None:
+            sample_set = []
+            sample_prob = []
+            for i in range(self.n_samples):
+                omega_j, prob = self.scene.env_map.sample(random(), random())
+                sample_set.append(omega_j)
+                sample_prob.append(prob)
+        else:
+            pdf = UniformPDF()
+            sample_set, sample_prob = sample_set_hemisphere(self.n_samples, pdf, as_array=True)
+            # Center the sample directions around the normal (all at once, with the frame of the hit point)
+            frame = hit_object.get_frame(hit_data.normal)
+            sample_set = [Vector3D(x, y, z) for x, y, z in frame.to_world_batch(sample_set).tolist()]
+            sample_prob = sample_prob.tolist()
         samples_values = []
 
-        for omega_j in sample_set:
-            # Center the sample direction around the normal
-            omega_jbar = center_around_normal(omega_j, hit_data.normal)
+        for omega_jbar, prob in zip(sample_set, sample_prob):
+            cos_theta = Dot(hit_data.normal, omega_jbar)
+            if cos_theta <= 0.0 or prob <= 0.0:  # below the surface (only possible with env_map_sampling)
+                samples_values.append(BLACK)
+                continue
             r = Ray(hit_data.hit_point, omega_jbar)
 
             # Check if the ray hits an object
@@ -198,23 +634,551 @@ class CMCIntegrator(Integrator):  # Classic Monte Carlo Integrator
             else:
                 l_i = BLACK
 
-            # l_o = l_i * brdf * cos(theta)
-            l_o = l_i.multiply(brdf) * Dot(hit_data.normal, omega_jbar)
+            # l_o = l_i * brdf * cos(theta) / p(omega)
+            l_o = l_i.multiply_scaled(brdf, cos_theta / prob)
             samples_values.append(l_o)
         
         # Compute the CMC estimate
         result = RGBColor(0, 0, 0)
-        for val, prob in zip(samples_values, sample_prob):
-            result += val / prob
+        for val in samples_values:
+            result.iadd_scaled(val)
         return result / len(samples_values)
 
+    # Batched version of compute_color
+    def compute_color_batch(self, rays):
+        if self.control_variate is None or self.scene.env_map is None:
+            return self.sample_radiance_batch(rays, self.n_samples).mean(axis=1)
+        return control_variate_estimates(*self.sample_radiance_batch(rays, self.n_samples, control=True))
+
+    # Single-sample estimates l_i * brdf * cos(theta) / p(omega) of the samples [sample_start, sample_start + n_samples)
+    # of each ray, as an (N, n_samples, 3) array (rays that miss the scene get their environment value in every sample)
+    # All the sample rays of the packet are traced as RayPackets of at most MAX_BATCH_RAYS rays
+    # control=True also returns the samples of the control variate (same layout, zero for the rays that miss the
+    # scene) and its (N, 3) integrals, see the control_variate parameter
+    def sample_radiance_batch(self, rays, n_samples, sample_start=0, control=False):
+        values = np.zeros((len(rays), n_samples, 3))
+        env_map = self.scene.env_map
+        hit_data = self.scene.closest_hit_batch(rays)
+        if env_map is not None:
+            values[~hit_data.has_hit] = env_map.lookup(rays.d[~hit_data.has_hit])[:, np.newaxis, :]
+        hit = np.flatnonzero(hit_data.has_hit)
+        control_values = np.zeros_like(values) if control else None
+        control_integrals = np.zeros((len(rays), 3)) if control else None
+        if len(hit) == 0:
+            return (values, control_values, control_integrals) if control else values
+        emission, kd = self.scene.get_material_arrays()
+        normals = hit_data.normal[hit]
+        n_hits = len(hit)
+
+        # Generate the sample sets (world space directions) and probabilities of all the hit points
+        u = self.random_uniforms(rays, hit, n_samples, 2, sample_start).reshape((-1, 2))
+        if self.env_map_sampling and env_map is not None:
+            sample_set, sample_prob = env_map.sample_batch(u)
+            sample_set = sample_set.reshape((n_hits, n_samples, 3))
+        else:
+            pdf = UniformPDF()
+            sample_set = pdf.generate_dirs(u)
+            sample_prob = pdf.get_vals(sample_set)
+            sample_set = FrameBatch(normals).to_world(sample_set.reshape((n_hits, n_samples, 3)))
+        sample_prob = sample_prob.reshape((n_hits, n_samples))
+        cos_theta = np.einsum('nmi,ni->nm', sample_set, normals)
+        valid = (cos_theta > 0.0) & (sample_prob > 0.0)  # below the surface only with env_map_sampling
+
+        # Trace the valid samples and fetch their incoming radiance (invalid samples stay zero)
+        hit_index, sample_index = np.nonzero(valid)
+        env_level = 0.0
+        if self.prefiltered and env_map is not None and not self.env_map_sampling:
+            env_level = env_map.level_for_solid_angle(1.0 / (self.n_samples * sample_prob[hit_index, sample_index]))
+        l_i = self.trace_radiance_batch(hit_data.hit_point[hit[hit_index]], sample_set[hit_index, sample_index],
+                                        env_level)
+
+        # l_o = l_i * brdf * cos(theta) / p(omega)
+        weights = cos_theta[hit_index, sample_index] / sample_prob[hit_index, sample_index]
+        brdf = kd[hit_data.primitive_index[hit[hit_index]]]
+        values[hit[hit_index], sample_index] = ColorArray(l_i).multiply_scaled(brdf, weights).data
+        if not control:
+            return values
+
+        # Control variate: the SH approximation of the environment map (unoccluded) instead of l_i
+        coefficients = env_map.sh_coefficients(self.control_variate)
+        l_approx = sh_basis(sample_set[hit_index, sample_index], self.control_variate) @ coefficients
+        control_values[hit[hit_index], sample_index] = ColorArray(l_approx).multiply_scaled(brdf, weights).data
+        control_integrals[hit] = kd[hit_data.primitive_index[hit]] * env_map.sh_irradiance(normals,
+                                                                                           self.control_variate)
+        return values, control_values, control_integrals
+
+    # Progressive render: the samples of every pixel are accumulated over several passes (running sums of the
+    # colors and of the luminance and squared luminance, for the per-pixel variance), and an image is saved each
+    # time the pixels reach one of the snapshot_counts (as <filename>_MC_<n>_samples<experiment_name>), so a
+    # whole convergence study costs a single render
+    # - error_threshold > 0: after the first snapshot only the pixels whose relative error (standard error of the
+    #   mean luminance over the mean luminance) is above error_threshold get more samples. A pixel is only stopped
+    #   once it has PROGRESSIVE_MIN_SAMPLES samples: with fewer, samples that all missed a small light (equal
+    #   luminance, zero estimated error) would freeze it
+    # - target_error: stop once the RMS relative error of the image is below target_error
+    # - time_budget: stop after time_budget seconds (the last pass may leave some pixels with more samples)
+    # checkpoint=path periodically saves the accumulation buffers, the position in the render and the random number
+    # generator state to a RenderCheckpoint, and resume=path continues the render saved there exactly where it
+    # stopped (the checkpoint is removed when the render finishes, unless it ran out of time)
+    # The final estimate is left in scene.rendered_image and the sample counts of the saved snapshots are returned
+    def render_progressive(self, snapshot_counts=None, error_threshold=0.0, target_error=None, time_budget=None,
+                           seed=RENDER_SEED, checkpoint=None, resume=None):
+        cam = self.scene.camera
+        snapshot_counts = sorted(set(int(n) for n in snapshot_counts)) if snapshot_counts is not None \
+            else [self.n_samples]
+        if len(snapshot_counts) == 0 or snapshot_counts[0] <= 0:
+            raise ValueError('Snapshot sample counts must be positive: ' + str(snapshot_counts))
+        print('Rendering Image (progressive): ' + self.get_filename())
+        self.scene.update()
+        n_pixels = cam.width * cam.height
+        ys, xs = np.divmod(np.arange(n_pixels), cam.width)
+        directions = cam.get_directions(xs, ys)
+        buffers = {'color_sum': np.zeros((n_pixels, 3)),
+                   'luminance_sum': np.zeros(n_pixels),
+                   'luminance_sq_sum': np.zeros(n_pixels),
+                   'counts': np.zeros(n_pixels, dtype=np.int64),
+                   'active': np.ones(n_pixels, dtype=bool)}
+        # position in the render: snapshot (stage) being rendered, first pixel batch of the stage not rendered yet
+        state = {'stage': 0, 'batch_start': 0, 'n_done': 0, 'saved_counts': [], 'elapsed': 0.0}
+        checkpoint_path = resume if resume is not None else checkpoint
+        checkpointer = None
+        if checkpoint_path is not None:
+            checkpointer = RenderCheckpoint(checkpoint_path, {
+                'mode': 'progressive', 'filename': self.get_filename(), 'width': cam.width, 'height': cam.height,
+                'snapshot_counts': [int(n) for n in snapshot_counts], 'error_threshold': error_threshold,
+                'env_map_sampling': self.env_map_sampling, 'seed': seed})
+        if resume is not None:
+            state, buffers = checkpointer.load()
+            set_rng_state(state['rng'])
+        else:
+            seed_rngs(seed)
+        self.init_render_sampler(seed)
+        if isinstance(self.render_sampler, StratifiedSampler) and self.render_sampler.n_total is None:
+            # stratify the samples of all the passes together, not each pass on its own
+            self.render_sampler = self.render_sampler.for_total(snapshot_counts[-1])
+        color_sum = buffers['color_sum']
+        luminance_sum = buffers['luminance_sum']
+        luminance_sq_sum = buffers['luminance_sq_sum']
+        counts = buffers['counts']
+        active = buffers['active']
+        stage = state['stage']
+        batch_start = state['batch_start']
+        n_done = state['n_done']  # samples per active pixel so far
+        saved_counts = state['saved_counts']
+        start_time = time.time() - state['elapsed']
+
+        def current_state():
+            return {'stage': stage, 'batch_start': batch_start, 'n_done': n_done, 'saved_counts': saved_counts,
+                    'elapsed': time.time() - start_time, 'rng': get_rng_state()}
+
+        out_of_time = False
+        progress = ProgressBar(snapshot_counts[-1])
+        progress.update(n_done)
+        while stage < len(snapshot_counts):
+            n_target = snapshot_counts[stage]
+            n_pass = n_target - n_done
+            pixels = np.flatnonzero(active)
+            pixels_per_batch = max(1, MAX_BATCH_RAYS // n_pass)
+            while batch_start < len(pixels):
+                batch = pixels[batch_start:batch_start + pixels_per_batch]
+                rays = RayPacket(np.zeros(3), directions[batch], pixel_index=batch)
+                values = self.sample_radiance_batch(rays, n_pass, n_done)
+                luminance = luminance_array(values)
+                color_sum[batch] += values.sum(axis=1)
+                luminance_sum[batch] += luminance.sum(axis=1)
+                luminance_sq_sum[batch] += (luminance * luminance).sum(axis=1)
+                counts[batch] += n_pass
+                batch_start += pixels_per_batch
+                if checkpointer is not None:
+                    checkpointer.maybe_save(buffers, current_state)
+                if time_budget is not None and time.time() - start_time > time_budget:
+                    out_of_time = True
+                    break
+            progress.update(n_pass)
+            self.scene.rendered_image[:] = (color_sum / np.maximum(counts, 1)[:, np.newaxis]).reshape(
+                (cam.height, cam.width, 3))
+            if out_of_time:
+                break
+            self.scene.save_image(self.snapshot_filename(n_target))
+            saved_counts.append(n_target)
+            n_done = n_target
+            stage += 1
+            batch_start = 0
+
+            errors = relative_errors(luminance_sum, luminance_sq_sum, counts)
+            if target_error is not None and np.sqrt(np.mean(errors * errors)) <= target_error:
+                break
+            if error_threshold > 0.0:
+                active &= (errors > error_threshold) | (counts < PROGRESSIVE_MIN_SAMPLES)
+                if not np.any(active):
+                    break
+        progress.finish()
+        if out_of_time:
+            self.scene.save_image(self.get_filename())
+        if checkpointer is not None:
+            if out_of_time:
+                checkpointer.save(buffers, current_state())  # can be resumed with a larger time budget
+            else:
+                checkpointer.remove()
+        return saved_counts
+
+    def snapshot_filename(self, n):
+        return self.base_filename + '_MC_' + str(n) + '_samples' + self.experiment_name
+
+
+# Control variate estimates of N pixels from the (N, n, 3) values f of their samples and the values g of a control
+# variate whose expectations are the (N, 3) control_integrals G: mean(f) - beta * (mean(g) - G), where the optimal
+# beta = Cov(f, g) / Var(g) of each pixel and channel is estimated from the same samples (0 if g is constant)
+def control_variate_estimates(values, control_values, control_integrals):
+    f_mean = values.mean(axis=1)
+    g_mean = control_values.mean(axis=1)
+    g_centered = control_values - g_mean[:, np.newaxis, :]
+    variance = np.sum(g_centered * g_centered, axis=1)
+    covariance = np.sum((values - f_mean[:, np.newaxis, :]) * g_centered, axis=1)
+    beta = np.where(variance > 0.0, covariance / np.where(variance > 0.0, variance, 1.0), 0.0)
+    return f_mean - beta * (g_mean - control_integrals)
+
+
+# Relative error of per-pixel Monte Carlo estimates from the running sums of n luminance samples:
+# standard error of the mean over the mean (pixels with fewer than 2 samples get an infinite error)
+def relative_errors(luminance_sum, luminance_sq_sum, counts):
+    n = np.maximum(counts, 2)
+    mean = luminance_sum / n
+    variance = np.maximum(luminance_sq_sum - luminance_sum * mean, 0.0) / (n - 1)
+    errors = np.sqrt(variance / n) / np.maximum(np.abs(mean), PROGRESSIVE_MIN_LUMINANCE)
+    errors[counts < 2] = np.inf
+    return errors
+
 
 class BayesianMonteCarloIntegrator(Integrator):
-    def __init__(self, n, myGP, filename_, experiment_name=''):
+    secondary_rays = 'hemisphere'
+
+    # The sample set is fixed for the whole image: the positions of myGP (n directions of the hemisphere around
+    # (0, 1, 0), by default a uniformly distributed Sobol point set), whose BMC weights are computed (and cached)
+    # only once. The estimate of each pixel is then the dot product of the weights with the incoming radiance of the
+    # sample directions rotated into the frame of the hit point (myGP.p_func must be the cosine term)
+    # prefiltered: the samples that reach the environment map fetch it at the mip level of their footprint (2 pi / n,
+    # see EnvironmentMap.level_for_solid_angle) instead of its full resolution texels
+    def __init__(self, n, myGP, filename_, experiment_name='', prefiltered=False):
         filename_bmc = filename_ + '_BMC_' + str(n) + '_samples' + experiment_name
         super().__init__(filename_bmc)
         self.n_samples = n
         self.myGP = myGP
+        self.prefiltered = prefiltered
+        if myGP.samples_pos is None or len(myGP.samples_pos) != n:
+            sample_set, _ = sample_set_hemisphere(n, UniformPDF(), as_array=True, sampler=SobolSampler())
+            myGP.add_sample_pos(sample_set)
 
     def compute_color(self, ray):
-        pass
+        hit_data = self.scene.closest_hit(ray)
+
+        # If no hit, return the environment map value or black
+        if not hit_data.has_hit:
+            if self.scene.env_map is not None:
+                return self.scene.env_map.getValue(ray.d)
+            else:
+                return BLACK
+
+        # Obtain the BRDF of the hit object
+        hit_object = self.scene.object_list[hit_data.primitive_index]
+        brdf = hit_object.get_BRDF().kd
+
+        # Rotate the sample set into the frame of the hit point and fetch the incoming radiance of each sample
+        frame = hit_object.get_frame(hit_data.normal)
+        sample_set = frame.to_world_batch(self.myGP.samples_pos)
+        hit_point = np.broadcast_to(vector_to_array(hit_data.hit_point), sample_set.shape)
+        self.myGP.add_sample_val(self.trace_radiance_batch(hit_point, sample_set, self.env_level()))
+
+        # BMC estimate of int l_i * cos, times the (constant) brdf
+        estimate = self.myGP.compute_integral_BMC()
+        return brdf.multiply(RGBColor(estimate[0], estimate[1], estimate[2]))
+
+    # Batched version of compute_color: the sample sets of all the hit points of the packet are traced at once
+    def compute_color_batch(self, rays):
+        colors = np.zeros((len(rays), 3))
+        hit_data = self.scene.closest_hit_batch(rays)
+        if self.scene.env_map is not None:
+            colors[~hit_data.has_hit] = self.scene.env_map.lookup(rays.d[~hit_data.has_hit])
+        hit = np.flatnonzero(hit_data.has_hit)
+        if len(hit) == 0:
+            return colors
+        emission, kd = self.scene.get_material_arrays()
+        n_hits = len(hit)
+        local_set = np.broadcast_to(self.myGP.samples_pos, (n_hits, self.n_samples, 3))
+        sample_set = FrameBatch(hit_data.normal[hit]).to_world(local_set)
+        hit_points = np.repeat(hit_data.hit_point[hit], self.n_samples, axis=0)
+        l_i = self.trace_radiance_batch(hit_points, sample_set.reshape((-1, 3)), self.env_level())
+        l_i = l_i.reshape((n_hits, self.n_samples, 3))
+        colors[hit] = ColorArray(np.einsum('m,nmc->nc', self.myGP.weights, l_i)).multiply(
+            kd[hit_data.primitive_index[hit]]).data
+        return colors
+
+    # Mip level of the environment map lookups of the samples (see prefiltered)
+    def env_level(self):
+        if self.prefiltered and self.scene.env_map is not None:
+            return self.scene.env_map.level_for_solid_angle(2.0 * PI / self.n_samples)
+        return 0.0
+
+
+class MISIntegrator(Integrator):  # Direct lighting with Multiple Importance Sampling
+    secondary_rays = 'hemisphere'
+    light_selection = True
+
+    # Each of the n samples of a hit point takes two samples of the incoming light, combined with the balance or the
+    # power heuristic (heuristic='balance' or 'power'):
+    # - a light sample: a light chosen with the emitter index of the scene (Scene.sample_lights, proportionally to
+    #   its power) and, for an emissive primitive, a point on it chosen uniformly by area. Point lights can only be
+    #   found this way (weight 1)
+    # - a BRDF sample: a cosine-weighted direction (CosinePDF), which also finds the environment map and the
+    #   emitters that can not be sampled by area (both with weight 1)
+    # Like CMCIntegrator, the emission of the primitives seen directly by the camera is not added
+    def __init__(self, n, filename_, experiment_name='', heuristic='power'):
+        if heuristic not in MIS_HEURISTICS:
+            raise ValueError('Unknown MIS heuristic: ' + str(heuristic))
+        filename_mis = filename_ + '_MIS_' + str(n) + '_samples' + experiment_name
+        super().__init__(filename_mis)
+        self.n_samples = n
+        self.heuristic = heuristic
+
+    # Per-ray version, runs compute_color_batch on a packet of one ray
+    def compute_color(self, ray):
+        return self.compute_color_via_batch(ray)
+
+    def compute_color_batch(self, rays):
+        colors = np.zeros((len(rays), 3))
+        env_map = self.scene.env_map
+        hit_data = self.scene.closest_hit_batch(rays)
+        if env_map is not None:
+            colors[~hit_data.has_hit] = env_map.lookup(rays.d[~hit_data.has_hit])
+        hit = np.flatnonzero(hit_data.has_hit)
+        if len(hit) == 0:
+            return colors
+        scene = self.scene
+        emission, kd = scene.get_material_arrays()
+        n_hits = len(hit)
+        x = hit_data.hit_point[hit]
+        normals = hit_data.normal[hit]
+        # dimensions of a sample: point on the emitter (0, 1), choice of the light (2), BRDF direction (3, 4)
+        u = self.random_uniforms(rays, hit, self.n_samples, 5)
+        hit_index = np.repeat(np.arange(n_hits), self.n_samples)
+        l_sum = np.zeros((n_hits, 3))  # sum of the weighted l_i * cos / pdf of the samples of each hit point
+
+        # Light samples
+        if scene.n_lights() > 0:
+            light, probability = scene.sample_lights(u[..., 2].reshape(-1))
+
+            # Emissive primitives
+            on_area = np.flatnonzero(scene.light_primitive[light] >= 0)
+            y, n_y = scene.sample_light_points(light[on_area], u[..., 0:2].reshape((-1, 2))[on_area])
+            w = y - x[hit_index[on_area]]
+            distance = np.sqrt(np.einsum('ij,ij->i', w, w))
+            w /= np.maximum(distance, EPSILON)[:, np.newaxis]
+            cos_x = np.einsum('ij,ij->i', w, normals[hit_index[on_area]])
+            cos_y = np.abs(np.einsum('ij,ij->i', w, n_y))
+            valid = np.flatnonzero((cos_x > 0.0) & (cos_y > 0.0) & (distance > EPSILON))
+            # The sampled point contributes if it is the closest hit of the ray towards it
+            r_hit = self.closest_hits(x[hit_index[on_area[valid]]], w[valid])
+            visible = r_hit.has_hit & (r_hit.primitive_index == scene.light_primitive[light[on_area[valid]]]) & \
+                (np.abs(r_hit.hit_distance - distance[valid]) <= LIGHT_VISIBILITY_TOLERANCE * distance[valid])
+            valid = valid[visible]
+            sample = on_area[valid]
+            pdf_light = probability[sample] * distance[valid] ** 2 / (scene.light_area[light[sample]] * cos_y[valid])
+            pdf_brdf = cos_x[valid] * INVERTED_PI
+            weight = mis_weight(pdf_light, pdf_brdf, self.heuristic) * cos_x[valid] / pdf_light
+            np.add.at(l_sum, hit_index[sample],
+                      (ColorArray(emission[scene.light_primitive[light[sample]]]) * weight).data)
+
+            # Point lights: l_i = intensity / d^2, the light is visible if nothing is hit before it
+            on_point = np.flatnonzero(scene.light_point[light] >= 0)
+            w = scene.point_light_positions[scene.light_point[light[on_point]]] - x[hit_index[on_point]]
+            distance = np.sqrt(np.einsum('ij,ij->i', w, w))
+            w /= np.maximum(distance, EPSILON)[:, np.newaxis]
+            cos_x = np.einsum('ij,ij->i', w, normals[hit_index[on_point]])
+            valid = np.flatnonzero((cos_x > 0.0) & (distance > EPSILON))
+            r_hit = self.closest_hits(x[hit_index[on_point[valid]]], w[valid])
+            visible = ~r_hit.has_hit | (r_hit.hit_distance >= (1.0 - LIGHT_VISIBILITY_TOLERANCE) * distance[valid])
+            valid = valid[visible]
+            sample = on_point[valid]
+            weight = cos_x[valid] / (probability[sample] * distance[valid] ** 2)
+            np.add.at(l_sum, hit_index[sample],
+                      (ColorArray(scene.point_light_intensities[scene.light_point[light[sample]]]) * weight).data)
+
+        # BRDF samples
+        pdf = CosinePDF(1)
+        local_dirs = pdf.generate_dirs(u[..., 3:5].reshape((-1, 2)))
+        pdf_brdf = pdf.get_vals(local_dirs)
+        w = FrameBatch(normals).to_world(local_dirs.reshape((n_hits, self.n_samples, 3))).reshape((-1, 3))
+        cos_x = np.einsum('ij,ij->i', w, normals[hit_index])
+        valid = np.flatnonzero((cos_x > 0.0) & (pdf_brdf > 0.0))
+        r_hit = self.closest_hits(x[hit_index[valid]], w[valid])
+        l_i = np.zeros((len(valid), 3))
+        weight = np.ones(len(valid))
+        l_i[r_hit.has_hit] = emission[r_hit.primitive_index[r_hit.has_hit]]
+        if env_map is not None:
+            l_i[~r_hit.has_hit] = env_map.lookup(w[valid][~r_hit.has_hit])
+        # Emitters that the light samples could have chosen are weighted by MIS
+        light = np.where(r_hit.has_hit, scene.light_slot[r_hit.primitive_index], -1)
+        on_emitter = np.flatnonzero(light >= 0)
+        if len(on_emitter) > 0:
+            cos_y = np.abs(np.einsum('ij,ij->i', w[valid[on_emitter]], r_hit.normal[on_emitter]))
+            pdf_light = scene.light_probability(light[on_emitter]) * r_hit.hit_distance[on_emitter] ** 2 / \
+                (scene.light_area[light[on_emitter]] * np.maximum(cos_y, EPSILON))
+            weight[on_emitter] = mis_weight(pdf_brdf[valid[on_emitter]], pdf_light, self.heuristic)
+        weight *= cos_x[valid] / pdf_brdf[valid]
+        np.add.at(l_sum, hit_index[valid], (ColorArray(l_i) * weight).data)
+
+        # l_o = brdf * (sum of the weighted samples) / n
+        colors[hit] = (ColorArray(l_sum).multiply(kd[hit_data.primitive_index[hit]]) / self.n_samples).data
+        return colors
+
+
+# MIS weight of a sample taken with a strategy of density pdf_a, when the other strategy has density pdf_b
+def mis_weight(pdf_a, pdf_b, heuristic):
+    if heuristic == 'power':
+        pdf_a = pdf_a * pdf_a
+        pdf_b = pdf_b * pdf_b
+    total = pdf_a + pdf_b
+    return np.where(total > 0.0, pdf_a / np.where(total > 0.0, total, 1.0), 0.0)
+
+
+class PathTracingIntegrator(Integrator):  # Global illumination with iterative (wavefront) path tracing
+    secondary_rays = 'paths'
+
+    # Each of the n paths of a pixel starts at the camera hit point and bounces on the (Lambertian) primitives in
+    # cosine-weighted directions (CosinePDF), adding the emission (or the environment map) found at each bounce.
+    # All the live paths of a packet are kept in arrays and advanced one bounce at a time with batched intersection:
+    # paths that leave the scene, hit a black surface or are killed are dropped (compaction) before the next bounce.
+    # After rr_depth bounces a path survives with probability min(max(throughput), PATH_RR_MAX_SURVIVAL), and its
+    # throughput is divided by it (Russian roulette); no path is longer than max_depth bounces
+    # Like CMCIntegrator, the emission of the primitives seen directly by the camera is not added (a path tracer
+    # with max_depth=1 estimates the same image as CMCIntegrator)
+    # Every bounce takes 3 sample dimensions (direction (0, 1), Russian roulette (2)) from its own point sets of the
+    # render sampler, so the samplers with few dimensions can be used (a sampler that is the same for every point
+    # set, e.g. a bare HaltonSampler, would repeat the same directions at every bounce)
+    def __init__(self, n, filename_, experiment_name='', max_depth=PATH_MAX_DEPTH, rr_depth=PATH_RR_DEPTH):
+        filename_pt = filename_ + '_PT_' + str(n) + '_samples' + experiment_name
+        super().__init__(filename_pt)
+        self.n_samples = n
+        self.max_depth = max_depth
+        self.rr_depth = rr_depth
+
+    # Per-ray version, runs compute_color_batch on a packet of one ray
+    def compute_color(self, ray):
+        return self.compute_color_via_batch(ray)
+
+    def compute_color_batch(self, rays):
+        colors = np.zeros((len(rays), 3))
+        hit_data = self.scene.closest_hit_batch(rays)
+        if self.scene.env_map is not None:
+            colors[~hit_data.has_hit] = self.scene.env_map.lookup(rays.d[~hit_data.has_hit])
+        hit = np.flatnonzero(hit_data.has_hit)
+        # The paths of at most MAX_BATCH_RAYS / n camera rays are traced together
+        rays_per_batch = max(1, MAX_BATCH_RAYS // self.n_samples)
+        for start in range(0, len(hit), rays_per_batch):
+            batch = hit[start:start + rays_per_batch]
+            colors[batch] = self.trace_paths(rays, batch, hit_data)
+        return colors
+
+    # Radiance of the camera rays[batch] (which hit the scene), averaged over their n paths: an (len(batch), 3) array
+    def trace_paths(self, rays, batch, hit_data):
+        emission, kd = self.scene.get_material_arrays()
+        env_map = self.scene.env_map
+        n_paths = len(batch) * self.n_samples
+        radiance = np.zeros((n_paths, 3))
+        # State of the live paths (path k is the sample k % n of the camera ray batch[k // n])
+        path = np.arange(n_paths)  # index of the path in radiance
+        path_ray = path // self.n_samples  # camera ray of each path (index into batch)
+        x = hit_data.hit_point[batch][path_ray]
+        # the normals are turned towards the incoming rays (the paths can hit a sphere from inside)
+        normals = orient_normal(Vec3Array(hit_data.normal[batch]), Vec3Array(-rays.d[batch])).data[path_ray]
+        throughput = kd[hit_data.primitive_index[batch]][path_ray] * PI  # brdf * cos / pdf = kd * pi (albedo)
+        pdf = CosinePDF(1)
+
+        for bounce in range(self.max_depth):
+            u = self.path_uniforms(rays, batch, path, bounce)
+            # Russian roulette (and compaction of the paths with zero throughput)
+            survival = np.ones(len(path))
+            if bounce >= self.rr_depth:
+                survival = np.minimum(throughput.max(axis=1), PATH_RR_MAX_SURVIVAL)
+            alive = np.flatnonzero((u[:, 2] < survival) & (throughput.max(axis=1) > 0.0))
+            path, x, normals, u = path[alive], x[alive], normals[alive], u[alive]
+            throughput = throughput[alive] / survival[alive, np.newaxis]
+            if len(path) == 0:
+                break
+
+            # Next vertex: the closest hit in a cosine-weighted direction
+            directions = FrameBatch(normals).to_world(pdf.generate_dirs(u[:, 0:2]))
+            r_hit = self.closest_hits(x, directions)
+            missed = ~r_hit.has_hit
+            if env_map is not None:
+                l_env = env_map.lookup(directions[missed])
+                radiance[path[missed]] += ColorArray(throughput[missed]).multiply(l_env).data
+            hit = np.flatnonzero(r_hit.has_hit)
+            primitives = r_hit.primitive_index[hit]
+            radiance[path[hit]] += ColorArray(throughput[hit]).multiply(emission[primitives]).data
+
+            # Compaction: only the paths that hit the scene continue
+            path = path[hit]
+            x = r_hit.hit_point[hit]
+            normals = orient_normal(Vec3Array(r_hit.normal[hit]), Vec3Array(-directions[hit])).data
+            throughput = ColorArray(throughput[hit]).multiply(kd[primitives] * PI).data
+            if len(path) == 0:
+                break
+        return radiance.reshape((len(batch), self.n_samples, 3)).mean(axis=1)
+
+    # (K, 3) points in [0, 1) of the bounce of K live paths (path: index of each path, n paths per camera ray of
+    # batch). Bounce b uses the point sets pixel_index + b * (number of pixels) of the render sampler, or the global
+    # generator when the rays do not know their pixel
+    def path_uniforms(self, rays, batch, path, bounce):
+        if self.render_sampler is None or rays.pixel_index is None:
+            return np.random.rand(len(path), 3)
+        path_ray, path_sample = np.divmod(path, self.n_samples)
+        rays_alive, path_set = np.unique(path_ray, return_inverse=True)
+        n_pixels = self.scene.camera.width * self.scene.camera.height
+        u = self.render_sampler.generate(rays.pixel_index[batch[rays_alive]] + bounce * n_pixels, self.n_samples, 3)
+        return u[path_set, path_sample]
+
+
+class IrradianceMapIntegrator(Integrator):  # Diffuse shading from the prefiltered environment map
+    secondary_rays = 'none'
+
+    # The outgoing radiance of a Lambertian hit point lit by the environment map alone is kd * E(n), where
+    # E(n) = int L(w) max(0, n . w) dw is fetched from the cosine-prefiltered irradiance map
+    # (EnvironmentMap.irradiance): one lookup per pixel instead of n sample rays. Occlusion and the emitters are
+    # ignored, so it matches CMCIntegrator only where the whole hemisphere of a point sees the environment map
+    # method: name of the irradiance method in the file name (set by the subclasses)
+    def __init__(self, filename_, experiment_name='', method='IrradianceMap'):
+        super().__init__(filename_ + '_' + method + experiment_name)
+
+    # Per-ray version, runs compute_color_batch on a packet of one ray
+    def compute_color(self, ray):
+        return self.compute_color_via_batch(ray)
+
+    def compute_color_batch(self, rays):
+        colors = np.zeros((len(rays), 3))
+        env_map = self.scene.env_map
+        if env_map is None:
+            return colors
+        hit_data = self.scene.closest_hit_batch(rays)
+        colors[~hit_data.has_hit] = env_map.lookup(rays.d[~hit_data.has_hit])
+        hit = hit_data.has_hit
+        emission, kd = self.scene.get_material_arrays()
+        normals = orient_normal(Vec3Array(hit_data.normal[hit]), Vec3Array(-rays.d[hit])).data
+        colors[hit] = ColorArray(kd[hit_data.primitive_index[hit]]).multiply(self.irradiance(env_map, normals)).data
+        return colors
+
+    # Irradiance of the environment map at (N, 3) normals
+    def irradiance(self, env_map, normals):
+        return env_map.irradiance(normals)
+
+
+class SHIrradianceIntegrator(IrradianceMapIntegrator):  # Diffuse shading from the SH projection of the env map
+
+    # Same as IrradianceMapIntegrator, with E(n) evaluated analytically from the order 2 or 3 spherical harmonics
+    # projection of the environment map (EnvironmentMap.sh_irradiance)
+    def __init__(self, filename_, order=2, experiment_name=''):
+        super().__init__(filename_, experiment_name, method='SHIrradiance_order' + str(order))
+        self.order = order
+
+    def irradiance(self, env_map, normals):
+        return env_map.sh_irradiance(normals, self.order)
@@ -0,0 +1,60 @@
+from PyRT_Core import *
+
+
+# Scene with enough skewed (non-rectangular) parallelograms to be put in a BVH
+def skewed_parallelogram_scene(n_primitives=40, seed=0):
+    rng = np.random.default_rng(seed)
+    scene = Scene()
+    for _ in range(n_primitives):
+        point = Vector3D(*rng.uniform(-2.0, 2.0, 3))
+        s1 = Vector3D(*rng.uniform(-1.0, 1.0, 3))
+        s2 = s1 * rng.uniform(-0.8, 0.8) + Vector3D(*rng.uniform(-1.0, 1.0, 3))  # far from perpendicular to s1
+        scene.add_object(Parallelogram(point, s1, s2, RGBColor(1.0, 1.0, 1.0)))
+    scene.finalize()
+    return scene
+
+
+def random_rays(n_rays, seed=1):
+    rng = np.random.default_rng(seed)
+    origins = rng.uniform(-3.0, 3.0, (n_rays, 3))
+    directions = rng.normal(size=(n_rays, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    return origins, directions
+
+
+# Closest hit primitive of a ray, testing every primitive
+def brute_force_closest(scene, ray):
+    closest, distance = -1, HUGEVALUE
+    for i, obj in enumerate(scene.object_list):
+        hit = obj.intersect(ray)
+        if hit.has_hit and hit.hit_distance < distance:
+            closest, distance = i, hit.hit_distance
+    return closest
+
+
+def test_skewed_parallelogram_bvh_matches_brute_force():
+    scene = skewed_parallelogram_scene()
+    assert scene.bvh is not None
+    origins, directions = random_rays(3000)
+    batch_hits = scene.closest_hit_batch(RayPacket(origins, directions))
+    batch_occluded = scene.any_hit_batch(RayPacket(origins, directions))
+    for k in range(len(origins)):
+        ray = Ray(Vector3D(*origins[k]), Vector3D(*directions[k]))
+        expected = brute_force_closest(scene, ray)
+        assert scene.closest_hit(ray).primitive_index == expected
+        assert batch_hits.primitive_index[k] == expected
+        assert scene.any_hit(ray) == (expected >= 0)
+        assert batch_occluded[k] == (expected >= 0)
+
+
+def test_skewed_parallelogram_hit_region_matches_samples():
+    scene = skewed_parallelogram_scene(n_primitives=1)
+    obj = scene.object_list[0]
+    packed = Parallelogram.pack([obj])
+    u = np.random.default_rng(2).random((500, 2))
+    points, normals = Parallelogram.sample_points_batch(packed, np.zeros(500, dtype=np.int64), u)
+    # Rays aimed at the sampled points (from the side of the normal) must hit the parallelogram there
+    origins = points + normals
+    hits = scene.closest_hit_batch(RayPacket(origins, -normals))
+    assert np.all(hits.has_hit)
+    assert np.allclose(hits.hit_point, points)